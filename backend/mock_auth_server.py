@@ -0,0 +1,38 @@
+"""
+Local stand-in for the Emergent session-data endpoint, used to benchmark logins offline.
+
+    uvicorn mock_auth_server:app --port 8099
+    EMERGENT_AUTH_URL=http://127.0.0.1:8099/auth/v1/env/oauth/session-data uvicorn server:app
+
+MOCK_AUTH_LATENCY_MS adds an artificial delay per call and MOCK_AUTH_USERS spreads
+session ids over that many distinct users. Session ids starting with "invalid" get a 401.
+"""
+from fastapi import FastAPI, Request, HTTPException
+import asyncio
+import hashlib
+import os
+import uuid
+
+MOCK_AUTH_LATENCY_MS = float(os.environ.get('MOCK_AUTH_LATENCY_MS', '0'))
+MOCK_AUTH_USERS = int(os.environ.get('MOCK_AUTH_USERS', '1000'))
+
+app = FastAPI()
+
+@app.get("/auth/v1/env/oauth/session-data")
+async def session_data(request: Request):
+    """Return session data for any X-Session-ID"""
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id or session_id.startswith("invalid"):
+        raise HTTPException(status_code=401, detail="Invalid session")
+    
+    if MOCK_AUTH_LATENCY_MS:
+        await asyncio.sleep(MOCK_AUTH_LATENCY_MS / 1000)
+    
+    user_number = int(hashlib.sha1(session_id.encode()).hexdigest(), 16) % MOCK_AUTH_USERS
+    return {
+        "id": f"mock_{user_number}",
+        "email": f"loadtest{user_number}@example.com",
+        "name": f"Load Test {user_number}",
+        "picture": None,
+        "session_token": uuid.uuid4().hex
+    }
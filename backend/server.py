@@ -1,15 +1,27 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Cookie
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Cookie, Header, Query, WebSocket, WebSocketDisconnect
+from starlette.requests import HTTPConnection
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, CursorType, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure, DuplicateKeyError, BulkWriteError, CollectionInvalid
 import os
+import json
+import math
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
+from collections import OrderedDict, deque
 import uuid
+import time
+import asyncio
 from datetime import datetime, timezone, timedelta
 import httpx
+import jwt
+import numpy as np
+from bson import Binary, ObjectId
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -88,6 +100,10 @@ class ChatRoom(BaseModel):
     agent_id: str
     status: str = "active"  # active, approved, completed, cancelled
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Maintained by every send: latest message, its time, and unread counts keyed by participant id
+    last_message: Optional[dict] = None
+    last_message_at: Optional[datetime] = None
+    unread: dict = Field(default_factory=dict)
 
 class Message(BaseModel):
     message_id: str
@@ -95,10 +111,13 @@ class Message(BaseModel):
     sender_id: str
     sender_type: str  # wisher or agent
     content: str
+    client_message_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class MessageCreate(BaseModel):
     content: str
+    # Set by the app and reused on retries so a resent message is stored once
+    client_message_id: Optional[str] = Field(default=None, min_length=1, max_length=64)
 
 # ===================== LOCAL HUB MODELS =====================
 
@@ -183,35 +202,563 @@ class AddressCreate(BaseModel):
 class PhoneUpdate(BaseModel):
     phone: str
 
+# ===================== INDEXES =====================
+
+# Stored responses for Idempotency-Key replays are kept this long
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 60 * 60)))
+# An in_progress key left by a crashed or cancelled request can be taken over after this long
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '60'))
+
+# (collection, keys, options) for every index the routes rely on, ensured at startup
+INDEXES = [
+    ("users", [("user_id", ASCENDING)], {"unique": True}),
+    ("users", [("email", ASCENDING)], {}),
+    ("user_sessions", [("session_token", ASCENDING)], {"unique": True}),
+    ("user_sessions", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("user_sessions", [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ("revoked_sessions", [("jti", ASCENDING)], {"unique": True}),
+    ("revoked_sessions", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("wishes", [("wish_id", ASCENDING)], {"unique": True}),
+    ("wishes", [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ("wishes", [("linked_order_id", ASCENDING)], {"sparse": True}),
+    ("chat_rooms", [("room_id", ASCENDING)], {"unique": True}),
+    ("chat_rooms", [("wisher_id", ASCENDING), ("last_message_at", DESCENDING), ("created_at", DESCENDING)], {}),
+    ("messages", [("message_id", ASCENDING)], {"unique": True}),
+    ("messages", [("room_id", ASCENDING), ("client_message_id", ASCENDING)],
+     {"unique": True, "partialFilterExpression": {"client_message_id": {"$type": "string"}}}),
+    ("messages", [("room_id", ASCENDING), ("created_at", ASCENDING), ("message_id", ASCENDING)], {}),
+    ("explore_posts", [("post_id", ASCENDING)], {}),
+    ("explore_posts", [("created_at", DESCENDING)], {}),
+    ("local_businesses", [("business_id", ASCENDING)], {}),
+    ("local_businesses", [("category", ASCENDING)], {}),
+    ("hub_vendors", [("vendor_id", ASCENDING)], {"unique": True}),
+    ("hub_vendors", [("category", ASCENDING)], {}),
+    ("hub_vendors", [("geo", GEOSPHERE), ("category", ASCENDING)], {}),
+    ("products", [("product_id", ASCENDING)], {"unique": True}),
+    ("products", [("vendor_id", ASCENDING), ("is_available", ASCENDING), ("category", ASCENDING)], {}),
+    ("carts", [("user_id", ASCENDING), ("vendor_id", ASCENDING)], {"unique": True}),
+    ("carts", [("user_id", ASCENDING), ("vendor_id", ASCENDING), ("item_count", ASCENDING)], {}),
+    ("shop_orders", [("order_id", ASCENDING)], {"unique": True}),
+    ("stock_reservations", [("user_id", ASCENDING), ("vendor_id", ASCENDING)], {"unique": True}),
+    ("stock_reservations", [("expires_at", ASCENDING)], {}),
+    ("agent_locations", [("order_id", ASCENDING)], {"unique": True}),
+    ("agent_trails", [("order_id", ASCENDING)], {"unique": True}),
+    ("idempotency_keys", [("user_id", ASCENDING), ("key", ASCENDING)], {"unique": True}),
+    ("idempotency_keys", [("created_at", ASCENDING)], {"expireAfterSeconds": IDEMPOTENCY_TTL_SECONDS}),
+    ("shop_orders", [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+]
+
+# (collection, filter, sort) for every query shape the routes issue; checked with `python server.py check-indexes`
+QUERY_SHAPES = [
+    ("users", {"email": "x"}, None),
+    ("users", {"user_id": "x"}, None),
+    ("user_sessions", {"session_token": "x", "expires_at": {"$gt": datetime(2000, 1, 1)}}, None),
+    ("user_sessions", {"user_id": "x"}, [("created_at", -1)]),
+    ("revoked_sessions", {"expires_at": {"$gt": datetime(2000, 1, 1)}}, None),
+    ("wishes", {"user_id": "x"}, [("created_at", -1)]),
+    ("wishes", {"wish_id": "x"}, None),
+    ("wishes", {"wish_id": "x", "user_id": "x"}, None),
+    ("wishes", {"linked_order_id": "x"}, None),
+    ("chat_rooms", {"wisher_id": "x"}, [("last_message_at", -1), ("created_at", -1)]),
+    ("wishes", {"wish_id": {"$in": ["x", "y"]}}, None),
+    ("chat_rooms", {"room_id": "x", "wisher_id": "x"}, None),
+    ("messages", {"room_id": "x"}, [("created_at", -1), ("message_id", -1)]),
+    ("messages", {"room_id": "x", "message_id": "x"}, None),
+    ("messages", {"room_id": "x", "client_message_id": "x"}, None),
+    ("messages", {"room_id": "x", "$or": [
+        {"created_at": {"$gt": datetime(2000, 1, 1)}},
+        {"created_at": datetime(2000, 1, 1), "message_id": {"$gt": "x"}}
+    ]}, [("created_at", 1), ("message_id", 1)]),
+    ("explore_posts", {}, [("created_at", -1)]),
+    ("explore_posts", {"post_id": "x"}, None),
+    ("local_businesses", {"category": "x"}, None),
+    ("local_businesses", {"business_id": "x"}, None),
+    ("hub_vendors", {"vendor_id": "x"}, None),
+    ("hub_vendors", {"vendor_id": {"$in": ["x", "y"]}}, None),
+    ("hub_vendors", {"category": "x"}, None),
+    ("products", {"product_id": "x"}, None),
+    ("products", {"product_id": {"$in": ["x", "y"]}}, None),
+    ("products", {"vendor_id": "x", "is_available": True}, None),
+    ("products", {"vendor_id": "x", "is_available": True, "category": "x"}, None),
+    ("carts", {"user_id": "x", "vendor_id": "x"}, None),
+    ("carts", {"user_id": "x"}, None),
+    ("shop_orders", {"user_id": "x"}, [("created_at", -1)]),
+    ("shop_orders", {"order_id": "x", "user_id": "x"}, None),
+    ("shop_orders", {"order_id": "x"}, None),
+    ("stock_reservations", {"user_id": "x", "vendor_id": "x", "expires_at": {"$gt": datetime(2000, 1, 1)}}, None),
+    ("stock_reservations", {"expires_at": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("idempotency_keys", {"user_id": "x", "key": "x"}, None),
+    ("agent_locations", {"order_id": "x"}, None),
+    ("agent_trails", {"order_id": "x"}, None),
+]
+
+# (collection, pipeline) for every aggregation the routes issue, explained the same way
+AGGREGATION_SHAPES = [
+    ("hub_vendors", [{"$geoNear": {
+        "near": {"type": "Point", "coordinates": [0, 0]}, "key": "geo", "distanceField": "distance_m",
+        "maxDistance": 1000, "query": {}, "spherical": True
+    }}]),
+    ("hub_vendors", [{"$geoNear": {
+        "near": {"type": "Point", "coordinates": [0, 0]}, "key": "geo", "distanceField": "distance_m",
+        "maxDistance": 1000, "query": {"category": "x"}, "spherical": True
+    }}]),
+]
+
+# Raised when an index with the same keys or name exists with different options
+INDEX_CONFLICT_CODES = {85, 86}
+INDEX_NOT_FOUND_CODE = 27
+
+async def index_options(collection, keys) -> Optional[dict]:
+    """create_index options of the existing index on keys, or None if there is none"""
+    for name, spec in (await collection.index_information()).items():
+        if spec["key"] == list(keys):
+            return {"name": name, **{k: v for k, v in spec.items() if k not in ("key", "v", "ns")}}
+    return None
+
+async def ensure_indexes():
+    """Create every declared index, replacing ones whose options changed
+
+    An index with the same keys cannot exist twice, so a rebuild drops the old one first. If the
+    new one then fails (for example duplicates under a new unique constraint) the old index is
+    restored and startup is aborted, rather than running on without it.
+    """
+    try:
+        await merge_duplicate_carts()
+    except PyMongoError as e:
+        logger.error(f"Duplicate cart merge failed: {e}")
+    for collection_name, keys, options in INDEXES:
+        collection = db[collection_name]
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                logger.error(f"Index {collection_name} {keys} not created: {e}")
+                continue
+            logger.info(f"Rebuilding index {collection_name} {keys} with {options}")
+            previous = await index_options(collection, keys)
+            try:
+                await collection.drop_index(keys)
+            except OperationFailure as drop_error:
+                # Another worker starting up at the same time may have dropped it first
+                if drop_error.code != INDEX_NOT_FOUND_CODE:
+                    logger.error(f"Index {collection_name} {keys} not rebuilt: {drop_error}")
+                    continue
+            try:
+                await collection.create_index(keys, **options)
+            except PyMongoError:
+                if previous is not None:
+                    await collection.create_index(keys, **previous)
+                logger.error(f"Index {collection_name} {keys} could not be rebuilt with {options}; previous index restored")
+                raise
+        except PyMongoError as e:
+            logger.error(f"Index {collection_name} {keys} not created: {e}")
+
+def plan_stages(plan) -> List[str]:
+    """All stage names in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+def winning_plan_stages(explain) -> List[str]:
+    """Stage names of every winning plan in an explain() result
+
+    Aggregation explains nest the query planner output under their first stage, so winning plans are
+    looked up anywhere in the document; rejected plans are skipped.
+    """
+    stages = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                stages.extend(plan_stages(value))
+            elif key != "rejectedPlans":
+                stages.extend(winning_plan_stages(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            stages.extend(winning_plan_stages(value))
+    return stages
+
+def report_plan(shape: str, explain: dict) -> bool:
+    """Log how a query shape is planned; False if it scans a whole collection"""
+    stages = winning_plan_stages(explain)
+    if "COLLSCAN" in stages:
+        logger.error(f"COLLSCAN: {shape}")
+        return False
+    if "SORT" in stages:
+        logger.warning(f"In-memory sort: {shape}")
+    else:
+        logger.info(f"OK: {shape} -> {stages}")
+    return True
+
+async def check_query_plans() -> bool:
+    """Explain every declared query and aggregation shape; False if any of them scans a whole collection"""
+    await ensure_indexes()
+    ok = True
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        ok = report_plan(f"{collection_name} {query} sort={sort}", explain) and ok
+    for collection_name, pipeline in AGGREGATION_SHAPES:
+        explain = await db.command(
+            "explain",
+            {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}},
+            verbosity="queryPlanner"
+        )
+        ok = report_plan(f"{collection_name} {pipeline}", explain) and ok
+    return ok
+
+# ===================== SESSION CACHE =====================
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+# Without EVENT_BUS, logouts and profile changes reach only the worker that handled them;
+# other workers keep serving their cached entry for at most this long, so keep it short
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+
+class SessionCache:
+    """Bounded LRU of session token -> (user doc, session expiry), entries live at most ttl_seconds"""
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # token -> (user_doc, expires_at, cached_until)
+        self._tokens_by_user = {}  # user_id -> set of tokens, for profile invalidation
+
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        user_doc, expires_at, cached_until = entry
+        if cached_until < time.monotonic() or expires_at < datetime.now(timezone.utc):
+            self.invalidate(token)
+            return None
+        self._entries.move_to_end(token)
+        return user_doc
+
+    def set(self, token: str, user_doc: dict, expires_at: datetime):
+        if self.maxsize <= 0:
+            return
+        self.invalidate(token)
+        self._entries[token] = (user_doc, expires_at, time.monotonic() + self.ttl_seconds)
+        self._tokens_by_user.setdefault(user_doc["user_id"], set()).add(token)
+        while len(self._entries) > self.maxsize:
+            oldest_token = next(iter(self._entries))
+            self.invalidate(oldest_token)
+
+    def invalidate(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[0]["user_id"]
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+    def invalidate_user(self, user_id: str):
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self.invalidate(token)
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL_SECONDS)
+
+def invalidate_cached_sessions(user_id: str):
+    """Drop a user's cached sessions on this worker and, through the event bus, on the others
+
+    Only the user id is broadcast, never tokens; other workers re-read the user's sessions on next use.
+    """
+    event_hub.publish("session_cache", "invalidate_user", {"user_id": user_id})
+
+# ===================== SIGNED SESSION TOKENS =====================
+
+# When set, the server issues its own HS256 session tokens and validates them without touching user_sessions
+SESSION_SIGNING_SECRET = os.environ.get('SESSION_SIGNING_SECRET')
+REVOCATION_REFRESH_SECONDS = float(os.environ.get('REVOCATION_REFRESH_SECONDS', '30'))
+# Refreshes re-read this far behind the newest revocation seen: an upsert can commit after a
+# later one has already been synced, and revoked_at may come from more than one server clock
+REVOCATION_SYNC_OVERLAP_SECONDS = float(os.environ.get('REVOCATION_SYNC_OVERLAP_SECONDS', '300'))
+SESSION_LIFETIME = timedelta(days=7)
+
+def is_signed_session_token(token: str) -> bool:
+    return bool(SESSION_SIGNING_SECRET) and token.count(".") == 2
+
+def issue_signed_session_token(user_id: str, expires_at: datetime) -> str:
+    """Create a signed session token carrying user_id and expiry"""
+    payload = {
+        "sub": user_id,
+        "exp": expires_at,
+        "iat": datetime.now(timezone.utc),
+        "jti": uuid.uuid4().hex
+    }
+    return jwt.encode(payload, SESSION_SIGNING_SECRET, algorithm="HS256")
+
+def decode_signed_session_token(token: str) -> Optional[dict]:
+    """Return the token claims, or None if the signature or expiry is invalid"""
+    try:
+        return jwt.decode(
+            token,
+            SESSION_SIGNING_SECRET,
+            algorithms=["HS256"],
+            options={"require": ["sub", "exp", "jti"]}
+        )
+    except jwt.PyJWTError:
+        return None
+
+class RevocationSet:
+    """Revoked token ids (jti) -> token expiry; an entry is only kept until the token would have expired anyway"""
+
+    def __init__(self):
+        self._revoked = {}
+        self.synced_at = None  # revoked_at of the newest revocation loaded from Mongo
+
+    def add(self, jti: str, expires_ts: float):
+        self._revoked[jti] = expires_ts
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def prune(self):
+        now_ts = time.time()
+        for jti in [jti for jti, expires_ts in self._revoked.items() if expires_ts < now_ts]:
+            del self._revoked[jti]
+
+revoked_sessions = RevocationSet()
+
+async def revoke_signed_session(claims: dict):
+    """Record a logout so every worker rejects the token until it expires"""
+    revoked_sessions.add(claims["jti"], claims["exp"])
+    # revoked_at comes from the database clock rather than this worker's
+    await db.revoked_sessions.update_one(
+        {"jti": claims["jti"]},
+        {
+            "$setOnInsert": {
+                "jti": claims["jti"],
+                "user_id": claims["sub"],
+                "expires_at": datetime.fromtimestamp(claims["exp"], tz=timezone.utc)
+            },
+            "$currentDate": {"revoked_at": True}
+        },
+        upsert=True
+    )
+
+async def sync_revoked_sessions():
+    """Load revocations from Mongo (all live ones at startup, then the recent ones; repeats are harmless)"""
+    query = {"expires_at": {"$gt": datetime.now(timezone.utc)}}
+    if revoked_sessions.synced_at is not None:
+        query["revoked_at"] = {"$gt": revoked_sessions.synced_at - timedelta(seconds=REVOCATION_SYNC_OVERLAP_SECONDS)}
+    
+    cursor = db.revoked_sessions.find(query, {"_id": 0, "jti": 1, "expires_at": 1, "revoked_at": 1})
+    async for doc in cursor:
+        expires_at = doc["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        revoked_sessions.add(doc["jti"], expires_at.timestamp())
+        if revoked_sessions.synced_at is None or doc["revoked_at"] > revoked_sessions.synced_at:
+            revoked_sessions.synced_at = doc["revoked_at"]
+    revoked_sessions.prune()
+
+async def refresh_revoked_sessions_loop():
+    """Pick up logouts performed on other workers"""
+    while True:
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+        try:
+            await sync_revoked_sessions()
+        except Exception as e:
+            logger.error(f"Revocation refresh error: {e}")
+
+# ===================== SESSION LIFECYCLE =====================
+
+MAX_SESSIONS_PER_USER = int(os.environ.get('MAX_SESSIONS_PER_USER', '10'))
+
+async def purge_expired_sessions():
+    """Report and remove sessions that expired while the TTL monitor was not running"""
+    now = datetime.now(timezone.utc)
+    try:
+        result = await db.user_sessions.delete_many({"expires_at": {"$lte": now}})
+        active = await db.user_sessions.count_documents({})
+    except PyMongoError as e:
+        logger.error(f"Session purge failed: {e}")
+        return
+    logger.info(f"Sessions at startup: {result.deleted_count} expired and removed, {active} active")
+
+async def prune_user_sessions(user_id: str):
+    """Keep only the newest MAX_SESSIONS_PER_USER sessions for a user"""
+    if MAX_SESSIONS_PER_USER <= 0:
+        return
+    stale = await db.user_sessions.find(
+        {"user_id": user_id},
+        {"_id": 1, "session_token": 1}
+    ).sort("created_at", -1).skip(MAX_SESSIONS_PER_USER).to_list(None)
+    if stale:
+        await db.user_sessions.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+        invalidate_cached_sessions(user_id)
+
+# ===================== AUTH SERVICE CLIENT =====================
+
+EMERGENT_AUTH_URL = os.environ.get(
+    'EMERGENT_AUTH_URL', 'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data'
+)
+AUTH_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('AUTH_CONNECT_TIMEOUT_SECONDS', '3'))
+AUTH_READ_TIMEOUT_SECONDS = float(os.environ.get('AUTH_READ_TIMEOUT_SECONDS', '5'))
+AUTH_MAX_CONNECTIONS = int(os.environ.get('AUTH_MAX_CONNECTIONS', '100'))
+AUTH_MAX_RETRIES = int(os.environ.get('AUTH_MAX_RETRIES', '2'))
+AUTH_RETRY_BACKOFF_SECONDS = float(os.environ.get('AUTH_RETRY_BACKOFF_SECONDS', '0.2'))
+AUTH_BREAKER_FAILURES = int(os.environ.get('AUTH_BREAKER_FAILURES', '5'))
+AUTH_BREAKER_RESET_SECONDS = float(os.environ.get('AUTH_BREAKER_RESET_SECONDS', '30'))
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets one trial call through per reset window"""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            # Half-open: restart the window so concurrent callers keep failing fast
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+auth_breaker = CircuitBreaker(AUTH_BREAKER_FAILURES, AUTH_BREAKER_RESET_SECONDS)
+
+# Shared keep-alive client, created at startup
+auth_http_client: Optional[httpx.AsyncClient] = None
+
+def create_auth_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            AUTH_READ_TIMEOUT_SECONDS,
+            connect=AUTH_CONNECT_TIMEOUT_SECONDS,
+            pool=AUTH_CONNECT_TIMEOUT_SECONDS
+        ),
+        limits=httpx.Limits(
+            max_connections=AUTH_MAX_CONNECTIONS,
+            max_keepalive_connections=AUTH_MAX_CONNECTIONS
+        )
+    )
+
+# Only retried when the request cannot have reached the upstream, or it reports being unavailable
+RETRYABLE_AUTH_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_AUTH_STATUSES = {502, 503, 504}
+# Statuses meaning the service is healthy but does not recognise the session
+REJECTED_SESSION_STATUSES = {401, 403, 404}
+
+async def fetch_session_data(session_id: str) -> dict:
+    """Exchange an Emergent session_id for the user's session data"""
+    if not auth_breaker.allow():
+        raise HTTPException(status_code=503, detail="Authentication service unavailable")
+    
+    last_error = None
+    for attempt in range(AUTH_MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(AUTH_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        try:
+            auth_response = await auth_http_client.get(
+                EMERGENT_AUTH_URL,
+                headers={"X-Session-ID": session_id}
+            )
+        except RETRYABLE_AUTH_ERRORS as e:
+            last_error = e
+            continue
+        except httpx.HTTPError as e:
+            last_error = e
+            break
+        
+        if auth_response.status_code in RETRYABLE_AUTH_STATUSES:
+            last_error = f"status {auth_response.status_code}"
+            continue
+        
+        if auth_response.status_code == 200:
+            auth_breaker.record_success()
+            return auth_response.json()
+        if auth_response.status_code in REJECTED_SESSION_STATUSES:
+            auth_breaker.record_success()
+            raise HTTPException(status_code=401, detail="Invalid session")
+        # 500, 429 and anything else unexpected is an upstream fault, not a bad session
+        last_error = f"status {auth_response.status_code}"
+        break
+    
+    auth_breaker.record_failure()
+    logger.error(f"Auth API error: {last_error!r}")
+    raise HTTPException(status_code=500, detail="Authentication service error")
+
 # ===================== AUTH HELPERS =====================
 
-async def get_current_user(request: Request, session_token: Optional[str] = Cookie(default=None)) -> Optional[User]:
-    """Get current user from session token (cookie or header)"""
+def get_request_token(connection: HTTPConnection, session_token: Optional[str]) -> Optional[str]:
+    """Session token from the cookie, falling back to the Authorization header"""
     token = session_token
-    
-    # Fallback to Authorization header
     if not token:
-        auth_header = request.headers.get("Authorization")
+        auth_header = connection.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             token = auth_header.split(" ")[1]
-    
+    return token
+
+async def get_current_user(request: Request, session_token: Optional[str] = Cookie(default=None)) -> Optional[User]:
+    """Get current user from session token (cookie or header)"""
+    return await get_user_for_token(get_request_token(request, session_token))
+
+async def get_user_for_token(token: Optional[str]) -> Optional[User]:
+    """Resolve a session token to its user, shared by HTTP and WebSocket auth"""
     if not token:
         return None
     
-    session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
-    if not session:
-        return None
-    
-    # Check expiry with timezone handling
-    expires_at = session["expires_at"]
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    
-    if expires_at < datetime.now(timezone.utc):
-        return None
+    # Signed tokens are validated on the CPU; revocations are checked even on a cache hit
+    claims = None
+    if is_signed_session_token(token):
+        claims = decode_signed_session_token(token)
+        if not claims or claims["jti"] in revoked_sessions:
+            return None
+    
+    # Cache hit costs no DB round trips
+    cached_user = session_cache.get(token)
+    if cached_user:
+        return User(**cached_user)
+    
+    if claims:
+        user_id = claims["sub"]
+        expires_at = datetime.fromtimestamp(claims["exp"], tz=timezone.utc)
+    else:
+        # Expired sessions are filtered in the query; the TTL monitor removes them within a minute
+        session = await db.user_sessions.find_one(
+            {"session_token": token, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "user_id": 1, "expires_at": 1}
+        )
+        if not session:
+            return None
+        
+        # Normalize expiry for the cache
+        expires_at = session["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        user_id = session["user_id"]
     
-    user_doc = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
+    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if user_doc:
+        session_cache.set(token, user_doc, expires_at)
         return User(**user_doc)
     return None
 
@@ -232,19 +779,7 @@ async def create_session(request: Request, response: Response):
         raise HTTPException(status_code=400, detail="Missing X-Session-ID header")
     
     # Call Emergent Auth API
-    async with httpx.AsyncClient() as client:
-        try:
-            auth_response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
-            )
-            if auth_response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Invalid session")
-            
-            user_data = auth_response.json()
-        except Exception as e:
-            logger.error(f"Auth API error: {e}")
-            raise HTTPException(status_code=500, detail="Authentication service error")
+    user_data = await fetch_session_data(session_id)
     
     session_data = SessionDataResponse(**user_data)
     
@@ -267,29 +802,34 @@ async def create_session(request: Request, response: Response):
         }
         await db.users.insert_one(new_user)
     
-    # Store session
-    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
-    session_doc = {
-        "user_id": user_id,
-        "session_token": session_data.session_token,
-        "expires_at": expires_at,
-        "created_at": datetime.now(timezone.utc)
-    }
-    await db.user_sessions.insert_one(session_doc)
+    # Store session (signed sessions are self-contained and need no session doc)
+    expires_at = datetime.now(timezone.utc) + SESSION_LIFETIME
+    if SESSION_SIGNING_SECRET:
+        session_token = issue_signed_session_token(user_id, expires_at)
+    else:
+        session_token = session_data.session_token
+        session_doc = {
+            "user_id": user_id,
+            "session_token": session_token,
+            "expires_at": expires_at,
+            "created_at": datetime.now(timezone.utc)
+        }
+        await db.user_sessions.insert_one(session_doc)
+        await prune_user_sessions(user_id)
     
     # Set cookie
     response.set_cookie(
         key="session_token",
-        value=session_data.session_token,
+        value=session_token,
         httponly=True,
         secure=True,
         samesite="none",
-        max_age=7*24*60*60,
+        max_age=int(SESSION_LIFETIME.total_seconds()),
         path="/"
     )
     
     user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    return {"user": user_doc, "session_token": session_data.session_token}
+    return {"user": user_doc, "session_token": session_token}
 
 @api_router.get("/auth/me")
 async def get_me(current_user: User = Depends(require_auth)):
@@ -299,14 +839,20 @@ async def get_me(current_user: User = Depends(require_auth)):
 @api_router.post("/auth/logout")
 async def logout(request: Request, response: Response, session_token: Optional[str] = Cookie(default=None)):
     """Logout user"""
-    token = session_token
-    if not token:
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            token = auth_header.split(" ")[1]
+    token = get_request_token(request, session_token)
     
     if token:
-        await db.user_sessions.delete_one({"session_token": token})
+        session_cache.invalidate(token)
+        claims = decode_signed_session_token(token) if is_signed_session_token(token) else None
+        if claims:
+            await revoke_signed_session(claims)
+        else:
+            session = await db.user_sessions.find_one_and_delete(
+                {"session_token": token},
+                projection={"_id": 0, "user_id": 1}
+            )
+            if session:
+                invalidate_cached_sessions(session["user_id"])
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out successfully"}
@@ -320,6 +866,7 @@ async def update_phone(phone_data: PhoneUpdate, current_user: User = Depends(req
         {"user_id": current_user.user_id},
         {"$set": {"phone": phone_data.phone}}
     )
+    invalidate_cached_sessions(current_user.user_id)
     return {"message": "Phone updated successfully"}
 
 class ProfileUpdate(BaseModel):
@@ -343,6 +890,7 @@ async def update_profile(profile_data: ProfileUpdate, current_user: User = Depen
             {"user_id": current_user.user_id},
             {"$set": update_fields}
         )
+        invalidate_cached_sessions(current_user.user_id)
     return {"message": "Profile updated successfully"}
 
 @api_router.post("/users/addresses")
@@ -355,6 +903,7 @@ async def add_address(address: AddressCreate, current_user: User = Depends(requi
         {"user_id": current_user.user_id},
         {"$push": {"addresses": address_doc}}
     )
+    invalidate_cached_sessions(current_user.user_id)
     return {"message": "Address added", "address": address_doc}
 
 @api_router.delete("/users/addresses/{address_id}")
@@ -364,6 +913,7 @@ async def delete_address(address_id: str, current_user: User = Depends(require_a
         {"user_id": current_user.user_id},
         {"$pull": {"addresses": {"id": address_id}}}
     )
+    invalidate_cached_sessions(current_user.user_id)
     return {"message": "Address deleted"}
 
 # ===================== WISH ENDPOINTS =====================
@@ -451,42 +1001,280 @@ async def update_wish(wish_id: str, wish_data: WishCreate, current_user: User =
     updated_wish = await db.wishes.find_one({"wish_id": wish_id}, {"_id": 0})
     return Wish(**updated_wish)
 
+# ===================== EVENTS =====================
+
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '64'))
+
+class Subscription:
+    """One subscriber's bounded event queue
+
+    A subscriber that falls a full queue behind is marked lagged and dropped from the hub,
+    so a slow client never holds events in memory or slows the publisher.
+    """
+
+    def __init__(self, hub: "EventHub", topic: str, maxsize: int):
+        self.topic = topic
+        self.lagged = False
+        self._hub = hub
+        self._queue = asyncio.Queue(maxsize)
+
+    def deliver(self, event: dict):
+        if self.lagged:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+            self._hub.unsubscribe(self)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Next event, or None when nothing arrives within timeout"""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+class EventHub:
+    """In-process pub/sub keyed by topic, such as order:<order_id>"""
+
+    def __init__(self):
+        self._subscribers = {}  # topic -> set of Subscription
+        self.bus: Optional["EventBus"] = None  # relays events to other workers when enabled
+        self._waiters = {}  # (topic, event_type) -> asyncio.Event set by the next matching event
+        self._waiting = {}  # (topic, event_type) -> number of parked waiters
+        self._listeners = {}  # topic -> callbacks run synchronously for every event, local or relayed
+
+    def subscribe(self, topic: str, maxsize: int = EVENT_QUEUE_SIZE) -> Subscription:
+        subscription = Subscription(self, topic, maxsize)
+        self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.topic]
+
+    def publish(self, topic: str, event_type: str, data: dict):
+        event = {"type": event_type, "data": data}
+        self.deliver(topic, event)
+        if self.bus:
+            self.bus.send(topic, event)
+
+    def listen(self, topic: str, callback):
+        self._listeners.setdefault(topic, []).append(callback)
+
+    def deliver(self, topic: str, event: dict):
+        """Hand an event to this worker's subscribers only"""
+        for callback in self._listeners.get(topic, ()):
+            callback(event)
+        for subscription in list(self._subscribers.get(topic, ())):
+            subscription.deliver(event)
+        waiter = self._waiters.pop((topic, event["type"]), None)
+        if waiter:
+            waiter.set()
+
+    async def wait(self, topic: str, event_type: str, check, timeout: float):
+        """Await check() until it returns something truthy, re-running it after each matching event
+
+        The waiter is registered before check() runs, so an event landing in between still wakes it.
+        Returns the last result of check(), which is falsy on timeout.
+        """
+        key = (topic, event_type)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            while True:
+                waiter = self._waiters.get(key)
+                if waiter is None:
+                    waiter = self._waiters[key] = asyncio.Event()
+                result = await check()
+                remaining = deadline - loop.time()
+                if result or remaining <= 0:
+                    return result
+                try:
+                    await asyncio.wait_for(waiter.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                self._waiters.pop(key, None)
+
+event_hub = EventHub()
+
+def session_cache_listener(event: dict):
+    session_cache.invalidate_user(event["data"]["user_id"])
+
+event_hub.listen("session_cache", session_cache_listener)
+
+def sse_event(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# ===================== EVENT BUS =====================
+
+EVENT_BUS_ENABLED = os.environ.get('EVENT_BUS', 'false').lower() in ('1', 'true', 'yes')
+EVENT_BUS_SIZE_MB = int(os.environ.get('EVENT_BUS_SIZE_MB', '16'))
+EVENT_BUS_OUTBOX_SIZE = 10000
+# ObjectIds from different workers are ordered only by their one-second timestamp,
+# so a resumed cursor starts a little early and skips events it has already seen
+EVENT_BUS_RESUME_SLACK_SECONDS = 5
+WORKER_ID = uuid.uuid4().hex[:12]
+
+class EventBus:
+    """Relays EventHub events between workers through the capped event_bus collection
+
+    Publishers deliver locally at once and queue the event for a batched insert. One tailable
+    await cursor per worker reads everyone's events and hands other workers' ones to the local hub.
+    """
+
+    def __init__(self, hub: EventHub):
+        self._hub = hub
+        self._outbox = deque(maxlen=EVENT_BUS_OUTBOX_SIZE)  # oldest events are dropped if Mongo is unreachable
+        self._outbox_ready = asyncio.Event()
+        self._seen = OrderedDict()  # recently received _ids
+        self._last_id = None
+
+    async def ensure_collection(self):
+        try:
+            await db.create_collection("event_bus", capped=True, size=EVENT_BUS_SIZE_MB * 1024 * 1024)
+        except CollectionInvalid:
+            options = await db.event_bus.options()
+            if not options.get("capped"):
+                logger.error("event_bus exists but is not a capped collection; cross-worker events will not be delivered")
+
+    def send(self, topic: str, event: dict):
+        self._outbox.append({"topic": topic, "type": event["type"], "data": event["data"], "origin": WORKER_ID})
+        self._outbox_ready.set()
+
+    async def write_loop(self):
+        while True:
+            await self._outbox_ready.wait()
+            self._outbox_ready.clear()
+            batch = list(self._outbox)
+            self._outbox.clear()
+            try:
+                await db.event_bus.insert_many(batch, ordered=True)
+            except PyMongoError as e:
+                logger.error(f"Event bus publish failed, dropped {len(batch)} events: {e}")
+
+    async def tail_loop(self):
+        # Start from now; after a reconnect resume from the last event seen
+        self._last_id = ObjectId.from_datetime(datetime.now(timezone.utc))
+        while True:
+            since = self._last_id.generation_time - timedelta(seconds=EVENT_BUS_RESUME_SLACK_SECONDS)
+            try:
+                cursor = db.event_bus.find(
+                    {"_id": {"$gt": ObjectId.from_datetime(since)}},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                )
+                while cursor.alive:
+                    async for doc in cursor:
+                        self._receive(doc)
+            except PyMongoError as e:
+                logger.error(f"Event bus tail error: {e}")
+            # A tailable cursor dies on an empty collection or when it falls out of the capped window
+            await asyncio.sleep(1)
+
+    def _receive(self, doc: dict):
+        if doc["_id"] in self._seen:
+            return
+        self._seen[doc["_id"]] = None
+        if len(self._seen) > EVENT_BUS_OUTBOX_SIZE:
+            self._seen.popitem(last=False)
+        if doc["_id"].generation_time > self._last_id.generation_time:
+            self._last_id = doc["_id"]
+        if doc.get("origin") != WORKER_ID:
+            self._hub.deliver(doc["topic"], {"type": doc["type"], "data": doc["data"]})
+
+event_bus = EventBus(event_hub)
+
 # ===================== CHAT ENDPOINTS =====================
 
+def chat_room_message_update(message: dict, unread_increments: dict) -> List[dict]:
+    """Room update pipeline for new messages: the newest becomes last_message unless the room already has
+    a later one, and unread counts grow by {participant_id: count}"""
+    # Stored times are millisecond precision, so a message sent in the same millisecond still counts as newer
+    is_newer = {"$gte": [message["created_at"], {"$ifNull": ["$last_message_at", datetime.min]}]}
+    return [{"$set": {
+        "last_message": {"$cond": [is_newer, {"$literal": message}, "$last_message"]},
+        "last_message_at": {"$cond": [is_newer, message["created_at"], "$last_message_at"]},
+        **{
+            f"unread.{participant_id}": {"$add": [{"$ifNull": [f"$unread.{participant_id}", 0]}, count]}
+            for participant_id, count in unread_increments.items()
+        }
+    }}]
+
+async def backfill_chat_room_activity():
+    """Add last_message and last_message_at to rooms created before they were maintained"""
+    room_ids = await db.chat_rooms.distinct("room_id", {"last_message_at": {"$exists": False}})
+    if not room_ids:
+        return
+    latest = await db.messages.aggregate([
+        {"$match": {"room_id": {"$in": room_ids}}},
+        {"$sort": {"room_id": 1, "created_at": -1}},
+        {"$group": {"_id": "$room_id", "message": {"$first": "$$ROOT"}}}
+    ]).to_list(None)
+    latest = {doc["_id"]: doc["message"] for doc in latest}
+    
+    operations = []
+    for room_id in room_ids:
+        message = latest.get(room_id)
+        if message:
+            message.pop("_id", None)
+        operations.append(UpdateOne(
+            {"room_id": room_id, "last_message_at": {"$exists": False}},
+            {"$set": {"last_message": message, "last_message_at": message["created_at"] if message else None}}
+        ))
+    await db.chat_rooms.bulk_write(operations, ordered=False)
+    logger.info(f"Backfilled last message on {len(operations)} chat rooms")
+
 @api_router.get("/chat/rooms", response_model=List[dict])
 async def get_chat_rooms(current_user: User = Depends(require_auth)):
     """Get all chat rooms for current user (wisher)"""
     rooms = await db.chat_rooms.find(
         {"wisher_id": current_user.user_id},
         {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+    ).sort([("last_message_at", -1), ("created_at", -1)]).to_list(100)
+    
+    wish_ids = list({room["wish_id"] for room in rooms})
+    wishes = await db.wishes.find({"wish_id": {"$in": wish_ids}}, {"_id": 0}).to_list(None)
+    wishes = {wish["wish_id"]: wish for wish in wishes}
     
-    # Enrich with wish and last message info
-    enriched_rooms = []
     for room in rooms:
-        wish = await db.wishes.find_one({"wish_id": room["wish_id"]}, {"_id": 0})
-        last_message = await db.messages.find_one(
-            {"room_id": room["room_id"]},
-            {"_id": 0}
-        )
-        if last_message:
-            last_message = await db.messages.find(
-                {"room_id": room["room_id"]},
-                {"_id": 0}
-            ).sort("created_at", -1).limit(1).to_list(1)
-            last_message = last_message[0] if last_message else None
-        
-        enriched_rooms.append({
-            **room,
-            "wish": wish,
-            "last_message": last_message
-        })
+        room["wish"] = wishes.get(room["wish_id"])
+        room.setdefault("last_message", None)
+        room["unread_count"] = room.pop("unread", {}).get(current_user.user_id, 0)
     
-    return enriched_rooms
+    return rooms
+
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_SYNC_LIMIT = 500
 
 @api_router.get("/chat/rooms/{room_id}/messages", response_model=List[Message])
-async def get_messages(room_id: str, current_user: User = Depends(require_auth)):
-    """Get messages for a chat room"""
+async def get_messages(
+    room_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    since: Optional[str] = None,
+    limit: Optional[int] = None,
+    current_user: User = Depends(require_auth)
+):
+    """Get messages for a chat room, oldest first
+
+    Without a cursor returns the latest page; before=<message_id> pages back through history,
+    after=<message_id> pages forward and since=<message_id> fetches everything new in one call.
+    Messages are ordered by (created_at, message_id).
+    """
+    if sum(cursor is not None for cursor in (before, after, since)) > 1:
+        raise HTTPException(status_code=400, detail="Use only one of before, after and since")
+    limit = min(max(limit or (MESSAGE_SYNC_LIMIT if since else MESSAGE_PAGE_SIZE), 1), MESSAGE_SYNC_LIMIT)
     # Verify user has access to this room
     room = await db.chat_rooms.find_one(
         {"room_id": room_id, "wisher_id": current_user.user_id},
@@ -495,13 +1283,42 @@ async def get_messages(room_id: str, current_user: User = Depends(require_auth))
     if not room:
         raise HTTPException(status_code=404, detail="Chat room not found")
     
-    messages = await db.messages.find(
-        {"room_id": room_id},
-        {"_id": 0}
-    ).sort("created_at", 1).to_list(500)
+    # Opening the room reads everything in it
+    if room.get("unread", {}).get(current_user.user_id):
+        await db.chat_rooms.update_one(
+            {"room_id": room_id},
+            {"$set": {f"unread.{current_user.user_id}": 0}}
+        )
     
+    newer = after is not None or since is not None
+    messages = await find_room_messages(room_id, before or after or since, newer, limit)
     return [Message(**m) for m in messages]
 
+async def find_room_messages(room_id: str, cursor_id: Optional[str], newer: bool, limit: int) -> List[dict]:
+    """Keyset page of a room's messages next to cursor_id (the latest page without one), oldest first"""
+    query = {"room_id": room_id}
+    if cursor_id is not None:
+        cursor = await db.messages.find_one(
+            {"room_id": room_id, "message_id": cursor_id},
+            {"_id": 0, "created_at": 1}
+        )
+        if not cursor:
+            raise HTTPException(status_code=400, detail="Unknown message cursor")
+        op = "$gt" if newer else "$lt"
+        query["$or"] = [
+            {"created_at": {op: cursor["created_at"]}},
+            {"created_at": cursor["created_at"], "message_id": {op: cursor_id}}
+        ]
+    
+    # Backwards pages are read newest first and flipped
+    direction = 1 if newer else -1
+    messages = await db.messages.find(query, {"_id": 0}).sort(
+        [("created_at", direction), ("message_id", direction)]
+    ).to_list(limit)
+    if not newer:
+        messages.reverse()
+    return messages
+
 @api_router.post("/chat/rooms/{room_id}/messages", response_model=Message)
 async def send_message(room_id: str, msg: MessageCreate, current_user: User = Depends(require_auth)):
     """Send a message in a chat room"""
@@ -513,16 +1330,180 @@ async def send_message(room_id: str, msg: MessageCreate, current_user: User = De
     if not room:
         raise HTTPException(status_code=404, detail="Chat room not found")
     
+    return await _post_message(room, current_user, msg.content, msg.client_message_id)
+
+MESSAGE_BATCH_MS = float(os.environ.get('MESSAGE_BATCH_MS', '0'))
+MESSAGE_BATCH_MAX = 200
+
+class MessageWriter:
+    """Commits sent messages, optionally grouping concurrent sends into one insert_many
+
+    With MESSAGE_BATCH_MS > 0 a send waits at most that long for others to join its batch; a full
+    batch is written at once. Room state updates for a batch go out as one bulk_write.
+    """
+
+    def __init__(self):
+        self._pending = []  # (room, message doc, future)
+        self._timer = None
+        self._flushes = set()  # flush tasks in flight, kept referenced until done
+
+    async def write(self, room: dict, doc: dict) -> bool:
+        """Store a message; False when the room already has a message with its client_message_id"""
+        if MESSAGE_BATCH_MS <= 0:
+            outcome = (await self._commit([(room, doc)]))[0]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((room, doc, future))
+        if len(self._pending) >= MESSAGE_BATCH_MAX:
+            # In its own task: cancelling this sender must not abandon the rest of the batch
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(MESSAGE_BATCH_MS / 1000)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            try:
+                outcomes = await self._commit([(room, doc) for room, doc, _ in batch])
+            except Exception as e:
+                outcomes = [e] * len(batch)
+            for (_, _, future), outcome in zip(batch, outcomes):
+                if future.done():  # sender went away
+                    continue
+                if isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+        finally:
+            # A cancelled flush still answers every sender, which may then retry with its client_message_id
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Message batch was interrupted"))
+
+    async def close(self):
+        """Write anything still queued and wait for flushes in flight"""
+        await asyncio.gather(*[t for t in (self._timer, *self._flushes) if t is not None], return_exceptions=True)
+        await self.flush()
+
+    async def _commit(self, entries: List[tuple]) -> list:
+        """Insert, update room state and publish; per entry True, False for a duplicate, or the error"""
+        outcomes = [True] * len(entries)
+        try:
+            # insert_many adds _id to the documents it is given
+            await db.messages.insert_many([dict(doc) for _, doc in entries], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                # keyPattern names the violated index; older servers only mention it in errmsg
+                retried = error["code"] == 11000 and "client_message_id" in str(error.get("keyPattern") or error["errmsg"])
+                outcomes[error["index"]] = False if retried else OperationFailure(error["errmsg"], error["code"])
+        
+        rooms = {}  # room_id -> (newest message, {participant_id: unread increment})
+        for (room, doc), outcome in zip(entries, outcomes):
+            if outcome is not True:
+                continue
+            newest, increments = rooms.setdefault(room["room_id"], (doc, {}))
+            if doc["created_at"] > newest["created_at"]:
+                rooms[room["room_id"]] = (doc, increments)
+            recipient_id = room["agent_id"] if doc["sender_id"] == room["wisher_id"] else room["wisher_id"]
+            increments[recipient_id] = increments.get(recipient_id, 0) + 1
+        if rooms:
+            try:
+                await db.chat_rooms.bulk_write([
+                    UpdateOne({"room_id": room_id}, chat_room_message_update(newest, increments))
+                    for room_id, (newest, increments) in rooms.items()
+                ], ordered=False)
+            except PyMongoError as e:
+                # The messages are stored; only the room listing lags
+                logger.error(f"Chat room update failed for {len(rooms)} rooms: {e}")
+        
+        for (room, doc), outcome in zip(entries, outcomes):
+            if outcome is True:
+                event_hub.publish(f"room:{room['room_id']}", "message", doc)
+        return outcomes
+
+message_writer = MessageWriter()
+
+async def _post_message(room: dict, sender: User, content: str, client_message_id: Optional[str] = None) -> Message:
+    """Store a message, update the room's activity and unread state, and fan it out to connected sockets"""
     message = Message(
         message_id=f"msg_{uuid.uuid4().hex[:12]}",
-        room_id=room_id,
-        sender_id=current_user.user_id,
+        room_id=room["room_id"],
+        sender_id=sender.user_id,
         sender_type="wisher",
-        content=msg.content
+        content=content,
+        client_message_id=client_message_id
     )
-    await db.messages.insert_one(message.dict())
+    if not await message_writer.write(room, message.dict()):
+        # A retried send: return what the first attempt stored
+        existing = await db.messages.find_one(
+            {"room_id": room["room_id"], "client_message_id": client_message_id},
+            {"_id": 0}
+        )
+        return Message(**existing)
     return message
 
+@api_router.websocket("/chat/rooms/{room_id}/ws")
+async def chat_room_socket(websocket: WebSocket, room_id: str):
+    """Live chat: pushes new room messages and accepts {"content": ..., "client_message_id": ...} frames to send"""
+    # Browsers cannot set headers on a WebSocket, so the token may also come as ?token=
+    token = get_request_token(websocket, websocket.cookies.get("session_token") or websocket.query_params.get("token"))
+    user = await get_user_for_token(token)
+    if not user:
+        await websocket.close(code=1008)
+        return
+    room = await db.chat_rooms.find_one(
+        {"room_id": room_id, "wisher_id": user.user_id},
+        {"_id": 0, "room_id": 1, "wisher_id": 1, "agent_id": 1}
+    )
+    if not room:
+        await websocket.close(code=1008)
+        return
+    
+    await websocket.accept()
+    subscription = event_hub.subscribe(f"room:{room_id}")
+    
+    async def push_events():
+        while True:
+            event = await subscription.get()
+            if subscription.lagged:
+                # The client reconnects and reloads history over HTTP
+                await websocket.close(code=1013)
+                return
+            await websocket.send_text(json.dumps(event, default=str))
+    
+    async def receive_messages():
+        while True:
+            frame = await websocket.receive_json()
+            if not isinstance(frame, dict):
+                continue
+            content, client_message_id = frame.get("content"), frame.get("client_message_id")
+            if isinstance(content, str) and content.strip():
+                await _post_message(room, user, content, client_message_id if isinstance(client_message_id, str) else None)
+    
+    tasks = [asyncio.create_task(push_events()), asyncio.create_task(receive_messages())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        subscription.close()
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception) and not isinstance(result, (WebSocketDisconnect, RuntimeError)):
+                logger.error(f"Chat socket error in room {room_id}: {result}")
+
 @api_router.put("/chat/rooms/{room_id}/approve")
 async def approve_deal(room_id: str, current_user: User = Depends(require_auth)):
     """Approve a deal with fulfillment agent"""
@@ -547,6 +1528,70 @@ async def approve_deal(room_id: str, current_user: User = Depends(require_auth))
     
     return {"message": "Deal approved!"}
 
+# ===================== LONG POLLING =====================
+
+LONG_POLL_MAX_SECONDS = float(os.environ.get('LONG_POLL_MAX_SECONDS', '30'))
+
+@api_router.get("/events/wait")
+async def wait_for_events(
+    room_id: Optional[str] = None,
+    order_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    timeout: float = Query(25, ge=0, le=LONG_POLL_MAX_SECONDS),
+    current_user: User = Depends(require_auth)
+):
+    """Long poll for clients that cannot keep a socket open
+
+    For a room, cursor is the last message_id the client has and new messages are returned; without
+    one the latest page is returned, so a client starts from there rather than from the oldest messages.
+    For an order, cursor is the number of status_history entries the client has and new entries are returned.
+    Responds as soon as there is something new, or empty with the same cursor after timeout seconds.
+    """
+    if (room_id is None) == (order_id is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of room_id and order_id")
+    if not math.isfinite(timeout) or not 0 <= timeout <= LONG_POLL_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"timeout must be between 0 and {LONG_POLL_MAX_SECONDS:g} seconds")
+    
+    if room_id is not None:
+        room = await db.chat_rooms.find_one(
+            {"room_id": room_id, "wisher_id": current_user.user_id},
+            {"_id": 0, "room_id": 1}
+        )
+        if not room:
+            raise HTTPException(status_code=404, detail="Chat room not found")
+        
+        async def new_messages():
+            if cursor is None:
+                return await find_room_messages(room_id, None, False, MESSAGE_PAGE_SIZE)
+            return await find_room_messages(room_id, cursor, True, MESSAGE_SYNC_LIMIT)
+        
+        messages = await event_hub.wait(f"room:{room_id}", "message", new_messages, timeout)
+        return {
+            "messages": [Message(**m) for m in messages],
+            "cursor": messages[-1]["message_id"] if messages else cursor
+        }
+    
+    try:
+        seen = int(cursor or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Order cursor must be a status_history count")
+    
+    async def order_changes():
+        order = await db.shop_orders.find_one(
+            {"order_id": order_id, "user_id": current_user.user_id},
+            {"_id": 0, "status": 1, "estimated_delivery": 1, "status_history": 1}
+        )
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        history = order.get("status_history", [])
+        return order if len(history) > seen else None
+    
+    order = await event_hub.wait(f"order:{order_id}", "status", order_changes, timeout)
+    if not order:
+        return {"status_history": [], "cursor": str(seen)}
+    history = order.pop("status_history")
+    return {**order, "status_history": history[seen:], "cursor": str(len(history))}
+
 # ===================== EXPLORE ENDPOINTS =====================
 
 @api_router.get("/explore", response_model=List[ExplorePost])
@@ -573,6 +1618,387 @@ async def get_business_categories():
     categories = await db.local_businesses.distinct("category")
     return categories
 
+# ===================== VENDOR GEO INDEX =====================
+
+# Vendors keep their {lat, lng, address} location for clients plus a GeoJSON copy in "geo" for the 2dsphere index
+VENDOR_PROJECTION = {"_id": 0, "geo": 0}
+
+def vendor_geo_point(location: dict) -> dict:
+    """GeoJSON point for a {lat, lng} location"""
+    return {"type": "Point", "coordinates": [location["lng"], location["lat"]]}
+
+async def backfill_vendor_geo():
+    """Add the GeoJSON point to vendors stored before it existed"""
+    vendors = await db.hub_vendors.find(
+        {"geo": {"$exists": False}, "location.lat": {"$exists": True}, "location.lng": {"$exists": True}},
+        {"_id": 0, "vendor_id": 1, "location": 1}
+    ).to_list(None)
+    if vendors:
+        await db.hub_vendors.bulk_write([
+            UpdateOne({"vendor_id": v["vendor_id"]}, {"$set": {"geo": vendor_geo_point(v["location"])}})
+            for v in vendors
+        ])
+        logger.info(f"Backfilled geo points for {len(vendors)} vendors")
+
+VENDOR_GEO_INDEX_ENABLED = os.environ.get('VENDOR_GEO_INDEX', 'false').lower() in ('1', 'true', 'yes')
+VENDOR_GEO_CELL_DEGREES = float(os.environ.get('VENDOR_GEO_CELL_DEGREES', '0.05'))  # ~5.5 km of latitude
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+class VendorGeoIndex:
+    """In-process nearby-vendor search: coordinates in contiguous NumPy arrays, bucketed by a lat/lng grid"""
+
+    def __init__(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._lat = np.empty(16)  # radians
+        self._lng = np.empty(16)  # radians
+        self._category = np.empty(16, dtype=object)
+        self._docs = []  # slot -> vendor doc (None once removed)
+        self._slots = {}  # vendor_id -> slot
+        self._cells = {}  # (row, col) -> list of slots
+        self._slot_cells = {}  # slot -> (row, col)
+        self._cell_arrays = {}  # (row, col) -> slots as an array, rebuilt lazily
+
+    def _cell(self, lat: float, lng: float) -> tuple:
+        return (int(np.floor(lat / self.cell_degrees)), int(np.floor(lng / self.cell_degrees)))
+
+    def _grow(self):
+        capacity = len(self._lat) * 2
+        for name in ("_lat", "_lng", "_category"):
+            old = getattr(self, name)
+            grown = np.empty(capacity, dtype=old.dtype)
+            grown[:len(old)] = old
+            setattr(self, name, grown)
+
+    def _detach(self, slot: int):
+        cell = self._slot_cells.pop(slot)
+        self._cells[cell].remove(slot)
+        if not self._cells[cell]:
+            del self._cells[cell]
+        self._cell_arrays.pop(cell, None)
+
+    def upsert(self, vendor: dict):
+        """Add or move one vendor"""
+        location = vendor.get("location") or {}
+        if location.get("lat") is None or location.get("lng") is None:
+            self.remove(vendor["vendor_id"])
+            return
+        
+        slot = self._slots.get(vendor["vendor_id"])
+        if slot is None:
+            slot = len(self._docs)
+            if slot == len(self._lat):
+                self._grow()
+            self._docs.append(None)
+            self._slots[vendor["vendor_id"]] = slot
+        else:
+            self._detach(slot)
+        
+        self._lat[slot] = np.radians(location["lat"])
+        self._lng[slot] = np.radians(location["lng"])
+        self._category[slot] = vendor.get("category")
+        self._docs[slot] = {k: v for k, v in vendor.items() if k not in VENDOR_PROJECTION}
+        cell = self._cell(location["lat"], location["lng"])
+        self._cells.setdefault(cell, []).append(slot)
+        self._slot_cells[slot] = cell
+        self._cell_arrays.pop(cell, None)
+
+    def get(self, vendor_id: str) -> Optional[dict]:
+        slot = self._slots.get(vendor_id)
+        return self._docs[slot] if slot is not None else None
+
+    def remove(self, vendor_id: str):
+        slot = self._slots.pop(vendor_id, None)
+        if slot is not None:
+            self._detach(slot)
+            self._docs[slot] = None
+
+    def _candidates(self, lat: float, lng: float, radius_km: float) -> np.ndarray:
+        lat_span = radius_km / KM_PER_DEGREE
+        lng_span = lat_span / max(np.cos(np.radians(lat)), 0.01)
+        row_min, col_min = self._cell(lat - lat_span, lng - lng_span)
+        row_max, col_max = self._cell(lat + lat_span, lng + lng_span)
+        chunks = []
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                cell = (row, col)
+                if cell not in self._cells:
+                    continue
+                if cell not in self._cell_arrays:
+                    self._cell_arrays[cell] = np.array(self._cells[cell], dtype=np.int64)
+                chunks.append(self._cell_arrays[cell])
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+    def nearby(self, lat: float, lng: float, radius_km: float, category: Optional[str], k: int) -> List[tuple]:
+        """Up to k (distance_km, vendor doc) pairs within radius_km, nearest first"""
+        slots = self._candidates(lat, lng, radius_km)
+        if category:
+            slots = slots[self._category[slots] == category]
+        if not len(slots):
+            return []
+        
+        # Haversine for every candidate in one pass
+        lat1, lng1 = np.radians(lat), np.radians(lng)
+        dlat = self._lat[slots] - lat1
+        dlng = self._lng[slots] - lng1
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(self._lat[slots]) * np.sin(dlng / 2) ** 2
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        
+        within = distances <= radius_km
+        slots, distances = slots[within], distances[within]
+        if k < len(slots):
+            top = np.argpartition(distances, k)[:k]
+            slots, distances = slots[top], distances[top]
+        order = np.argsort(distances, kind="stable")
+        return [(float(distances[i]), self._docs[slots[i]]) for i in order]
+
+    async def load(self):
+        """(Re)build the index from hub_vendors"""
+        self._reset()
+        async for vendor in db.hub_vendors.find({}, VENDOR_PROJECTION):
+            self.upsert(vendor)
+        self.loaded = True
+        logger.info(f"Vendor geo index loaded with {len(self._slots)} vendors")
+
+vendor_geo_index = VendorGeoIndex(VENDOR_GEO_CELL_DEGREES)
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    dlat = np.radians(lat2 - lat1)
+    dlng = np.radians(lng2 - lng1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlng / 2) ** 2
+    return float(2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(min(a, 1.0))))
+
+# ===================== NEARBY VENDOR CACHE =====================
+
+NEARBY_CACHE_SIZE = int(os.environ.get('NEARBY_CACHE_SIZE', '4096'))
+NEARBY_CACHE_TTL_SECONDS = float(os.environ.get('NEARBY_CACHE_TTL_SECONDS', '120'))
+NEARBY_TILE_DEGREES = float(os.environ.get('NEARBY_TILE_DEGREES', '0.01'))  # ~1.1 km
+NEARBY_RADIUS_BUCKETS_KM = (1.0, 2.0, 3.0, 5.0, 7.5, 10.0)
+
+class NearbyVendorCache:
+    """LRU+TTL of candidate vendors keyed by (location tile, radius bucket, category)
+
+    Each entry holds every vendor within the bucket radius of any point in the tile, so callers
+    refine exact distances from their own position on top of it.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float, tile_degrees: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.tile_degrees = tile_degrees
+        self._entries = OrderedDict()  # key -> (vendors, vendor_ids, cached_until)
+
+    def key(self, lat: float, lng: float, radius_km: float, category: Optional[str]) -> tuple:
+        tile = (int(np.floor(lat / self.tile_degrees)), int(np.floor(lng / self.tile_degrees)))
+        bucket = next((b for b in NEARBY_RADIUS_BUCKETS_KM if radius_km <= b), NEARBY_RADIUS_BUCKETS_KM[-1])
+        return (tile, bucket, category)
+
+    def cover(self, key: tuple) -> tuple:
+        """(lat, lng, radius_km) of the circle every entry for key must include"""
+        (row, col), bucket, _ = key
+        center_lat = (row + 0.5) * self.tile_degrees
+        center_lng = (col + 0.5) * self.tile_degrees
+        half_diagonal_km = self.tile_degrees * KM_PER_DEGREE * np.sqrt(2) / 2
+        return center_lat, center_lng, bucket + half_diagonal_km
+
+    def get(self, key: tuple) -> Optional[List[dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: tuple, vendors: List[dict]):
+        if self.maxsize <= 0:
+            return
+        vendor_ids = {v["vendor_id"] for v in vendors}
+        self._entries[key] = (vendors, vendor_ids, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate_vendor(self, vendor: dict):
+        """Drop entries that hold the vendor or whose area now contains it"""
+        location = vendor.get("location") or {}
+        for key in list(self._entries):
+            if vendor["vendor_id"] in self._entries[key][1]:
+                del self._entries[key]
+                continue
+            if location.get("lat") is None or location.get("lng") is None:
+                continue
+            center_lat, center_lng, cover_km = self.cover(key)
+            if haversine_km(center_lat, center_lng, location["lat"], location["lng"]) <= cover_km:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+nearby_vendor_cache = NearbyVendorCache(NEARBY_CACHE_SIZE, NEARBY_CACHE_TTL_SECONDS, NEARBY_TILE_DEGREES)
+
+async def nearby_vendors_from_cache(lat: float, lng: float, radius_km: float, category: Optional[str]) -> List[dict]:
+    """Vendors within radius_km of (lat, lng), nearest first, with distance_km"""
+    key = nearby_vendor_cache.key(lat, lng, radius_km, category)
+    candidates = nearby_vendor_cache.get(key)
+    if candidates is None:
+        center_lat, center_lng, cover_km = nearby_vendor_cache.cover(key)
+        query = {"category": category} if category else {}
+        candidates = await db.hub_vendors.aggregate([
+            {"$geoNear": {
+                "near": {"type": "Point", "coordinates": [center_lng, center_lat]},
+                "key": "geo",
+                "distanceField": "distance_m",
+                "maxDistance": cover_km * 1000,
+                "query": query,
+                "spherical": True
+            }},
+            {"$project": {**VENDOR_PROJECTION, "distance_m": 0}}
+        ]).to_list(None)
+        nearby_vendor_cache.set(key, candidates)
+    
+    vendors = []
+    for vendor in candidates:
+        distance = haversine_km(lat, lng, vendor["location"]["lat"], vendor["location"]["lng"])
+        if distance <= radius_km:
+            vendors.append({**vendor, "distance_km": round(distance, 2)})
+    vendors.sort(key=lambda v: v["distance_km"])
+    return vendors
+
+# ===================== VENDOR COVERAGE INDEX =====================
+
+COVERAGE_CELL_DEGREES = float(os.environ.get('COVERAGE_CELL_DEGREES', '0.05'))
+
+class VendorCoverageIndex:
+    """Grid of covering cells for vendor delivery circles, answering "which vendors deliver to this point"
+
+    A vendor is registered in every cell its delivery circle's bounding box touches, so a lookup is one
+    cell read plus an exact distance check on the few vendors registered there.
+    """
+
+    def __init__(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self.loaded = False
+        self._cells = {}  # (row, col) -> set of vendor_ids
+        self._vendors = {}  # vendor_id -> (lat, lng, delivery_radius_km, category, cells)
+
+    def _cell(self, lat: float, lng: float) -> tuple:
+        return (int(np.floor(lat / self.cell_degrees)), int(np.floor(lng / self.cell_degrees)))
+
+    def upsert(self, vendor: dict):
+        self.remove(vendor["vendor_id"])
+        location = vendor.get("location") or {}
+        if location.get("lat") is None or location.get("lng") is None:
+            return
+        lat, lng = location["lat"], location["lng"]
+        radius_km = vendor.get("delivery_radius_km", HubVendor.model_fields["delivery_radius_km"].default)
+        
+        lat_span = radius_km / KM_PER_DEGREE
+        lng_span = lat_span / max(np.cos(np.radians(lat)), 0.01)
+        row_min, col_min = self._cell(lat - lat_span, lng - lng_span)
+        row_max, col_max = self._cell(lat + lat_span, lng + lng_span)
+        cells = [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(vendor["vendor_id"])
+        self._vendors[vendor["vendor_id"]] = (lat, lng, radius_km, vendor.get("category"), cells)
+
+    def remove(self, vendor_id: str):
+        entry = self._vendors.pop(vendor_id, None)
+        if entry is None:
+            return
+        for cell in entry[4]:
+            self._cells[cell].discard(vendor_id)
+            if not self._cells[cell]:
+                del self._cells[cell]
+
+    def covering(self, lat: float, lng: float, category: Optional[str]) -> List[tuple]:
+        """(distance_km, vendor_id) for vendors whose delivery radius reaches (lat, lng), nearest first"""
+        matches = []
+        for vendor_id in self._cells.get(self._cell(lat, lng), ()):
+            vendor_lat, vendor_lng, radius_km, vendor_category, _ = self._vendors[vendor_id]
+            if category and vendor_category != category:
+                continue
+            distance = haversine_km(lat, lng, vendor_lat, vendor_lng)
+            if distance <= radius_km:
+                matches.append((distance, vendor_id))
+        matches.sort()
+        return matches
+
+    async def load(self):
+        self._cells = {}
+        self._vendors = {}
+        async for vendor in db.hub_vendors.find(
+            {}, {"_id": 0, "vendor_id": 1, "location": 1, "delivery_radius_km": 1, "category": 1}
+        ):
+            self.upsert(vendor)
+        self.loaded = True
+        logger.info(f"Vendor coverage index loaded with {len(self._vendors)} vendors")
+
+vendor_coverage_index = VendorCoverageIndex(COVERAGE_CELL_DEGREES)
+
+async def deliverable_vendors(lat: float, lng: float, category: Optional[str], skip: int, limit: int) -> List[dict]:
+    """Vendors whose own delivery_radius_km reaches (lat, lng), nearest first"""
+    if not vendor_coverage_index.loaded:
+        await vendor_coverage_index.load()
+    page = vendor_coverage_index.covering(lat, lng, category)[skip:skip + limit]
+    if not page:
+        return []
+    
+    if vendor_geo_index.loaded:
+        docs = {vendor_id: vendor_geo_index.get(vendor_id) for _, vendor_id in page}
+    else:
+        docs = await load_vendors(vendor_id for _, vendor_id in page)
+    return [
+        {**docs[vendor_id], "distance_km": round(distance, 2)}
+        for distance, vendor_id in page if docs.get(vendor_id)
+    ]
+
+# ===================== VENDOR CHANGE TRACKING =====================
+
+def on_vendor_changed(vendor: dict):
+    """Keep in-process vendor structures in step with a hub_vendors write"""
+    if vendor_geo_index.loaded:
+        vendor_geo_index.upsert(vendor)
+    if vendor_coverage_index.loaded:
+        vendor_coverage_index.upsert(vendor)
+    nearby_vendor_cache.invalidate_vendor(vendor)
+
+async def on_vendors_reset():
+    """Rebuild in-process vendor structures after deletes"""
+    nearby_vendor_cache.clear()
+    if vendor_geo_index.loaded:
+        await vendor_geo_index.load()
+    if vendor_coverage_index.loaded:
+        await vendor_coverage_index.load()
+
+# Change streams need a replica set; standalone servers return this code
+CHANGE_STREAM_UNSUPPORTED_CODES = {40573}
+
+async def watch_hub_vendors():
+    """Apply hub_vendors changes made by any process to the in-process structures"""
+    while True:
+        try:
+            async with db.hub_vendors.watch(full_document="updateLookup") as stream:
+                async for change in stream:
+                    if change["operationType"] in ("insert", "update", "replace") and change.get("fullDocument"):
+                        on_vendor_changed(change["fullDocument"])
+                    elif change["operationType"] in ("delete", "drop", "invalidate"):
+                        # Deletes only carry the _id, and they are rare: rebuild
+                        await on_vendors_reset()
+        except OperationFailure as e:
+            if e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                logger.info("hub_vendors change stream unavailable; in-process vendor data refreshes on local writes only")
+                return
+            logger.error(f"hub_vendors change stream error: {e}")
+        except PyMongoError as e:
+            logger.error(f"hub_vendors change stream error: {e}")
+        await asyncio.sleep(5)
+
 # ===================== HUB VENDOR SHOP ENDPOINTS =====================
 
 @api_router.get("/localhub/vendors")
@@ -580,46 +2006,41 @@ async def get_hub_vendors(
     lat: Optional[float] = None,
     lng: Optional[float] = None,
     radius_km: float = 5.0,
-    category: Optional[str] = None
+    category: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100,
+    deliverable: bool = False
 ):
-    """Get hub vendors with radius filtering (max 10km)"""
+    """Get hub vendors with radius filtering (max 10km), nearest first and paginated
+
+    With deliverable=true, return vendors whose own delivery radius reaches the caller instead.
+    """
     radius_km = min(radius_km, 10.0)  # Max 10km
+    skip = max(skip, 0)
+    limit = min(max(limit, 1), 100)
     
     query = {}
     if category:
         query["category"] = category
     
-    vendors = await db.hub_vendors.find(query, {"_id": 0}).to_list(100)
+    if lat is None or lng is None:
+        return await db.hub_vendors.find(query, VENDOR_PROJECTION).skip(skip).to_list(limit)
     
-    # If location provided, filter by distance
-    if lat and lng:
-        from math import radians, sin, cos, sqrt, atan2
-        
-        def haversine(lat1, lng1, lat2, lng2):
-            R = 6371  # Earth's radius in km
-            dlat = radians(lat2 - lat1)
-            dlng = radians(lng2 - lng1)
-            a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlng/2)**2
-            c = 2 * atan2(sqrt(a), sqrt(1-a))
-            return R * c
-        
-        filtered = []
-        for vendor in vendors:
-            if "location" in vendor:
-                distance = haversine(lat, lng, vendor["location"]["lat"], vendor["location"]["lng"])
-                if distance <= radius_km:
-                    vendor["distance_km"] = round(distance, 2)
-                    filtered.append(vendor)
-        
-        # Sort by distance
-        vendors = sorted(filtered, key=lambda x: x.get("distance_km", 999))
+    if deliverable:
+        return await deliverable_vendors(lat, lng, category, skip, limit)
     
-    return vendors
+    if vendor_geo_index.loaded:
+        matches = vendor_geo_index.nearby(lat, lng, radius_km, category, skip + limit)
+        return [{**vendor, "distance_km": round(distance, 2)} for distance, vendor in matches[skip:]]
+    
+    # Candidates come from the 2dsphere index once per tile, exact distances per request
+    vendors = await nearby_vendors_from_cache(lat, lng, radius_km, category)
+    return vendors[skip:skip + limit]
 
 @api_router.get("/localhub/vendors/{vendor_id}")
 async def get_vendor_details(vendor_id: str):
     """Get detailed vendor information"""
-    vendor = await db.hub_vendors.find_one({"vendor_id": vendor_id}, {"_id": 0})
+    vendor = await db.hub_vendors.find_one({"vendor_id": vendor_id}, VENDOR_PROJECTION)
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
     return vendor
@@ -655,9 +2076,45 @@ async def like_product(product_id: str, current_user: User = Depends(require_aut
 
 # ===================== CART ENDPOINTS (Multi-Shop Support) =====================
 
+async def load_products(product_ids) -> dict:
+    """product_id -> product doc, fetched in one query"""
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return {}
+    products = await db.products.find({"product_id": {"$in": product_ids}}, {"_id": 0}).to_list(None)
+    return {p["product_id"]: p for p in products}
+
+async def load_vendors(vendor_ids) -> dict:
+    """vendor_id -> vendor doc, fetched in one query"""
+    vendor_ids = [v for v in set(vendor_ids) if v]
+    if not vendor_ids:
+        return {}
+    vendors = await db.hub_vendors.find({"vendor_id": {"$in": vendor_ids}}, VENDOR_PROJECTION).to_list(None)
+    return {v["vendor_id"]: v for v in vendors}
+
+async def enrich_carts(carts: List[dict], include_vendor: bool = False):
+    """Attach product details to cart items (dropping unknown products) and optionally the vendor"""
+    product_ids = [item["product_id"] for cart in carts for item in cart.get("items", [])]
+    if include_vendor:
+        products, vendors = await asyncio.gather(
+            load_products(product_ids),
+            load_vendors(cart.get("vendor_id") for cart in carts)
+        )
+    else:
+        products, vendors = await load_products(product_ids), {}
+    
+    for cart in carts:
+        cart["items"] = [
+            {**item, "product": products[item["product_id"]]}
+            for item in cart.get("items", []) if item["product_id"] in products
+        ]
+        if include_vendor:
+            cart["vendor"] = vendors.get(cart.get("vendor_id"))
+
 @api_router.get("/cart")
 async def get_cart(vendor_id: Optional[str] = None, current_user: User = Depends(require_auth)):
     """Get user's cart for a specific vendor or all carts"""
+    await cart_write_behind.flush(current_user.user_id)
     if vendor_id:
         # Get cart for specific vendor
         cart = await db.carts.find_one(
@@ -668,122 +2125,559 @@ async def get_cart(vendor_id: Optional[str] = None, current_user: User = Depends
             return {"user_id": current_user.user_id, "items": [], "vendor_id": vendor_id}
         
         # Enrich with product details
-        enriched_items = []
-        for item in cart.get("items", []):
-            product = await db.products.find_one({"product_id": item["product_id"]}, {"_id": 0})
-            if product:
-                enriched_items.append({**item, "product": product})
-        
-        cart["items"] = enriched_items
+        await enrich_carts([cart])
         return cart
     else:
         # Get all carts for user
         carts = await db.carts.find({"user_id": current_user.user_id}, {"_id": 0}).to_list(100)
-        enriched_carts = []
-        for cart in carts:
-            vendor = await db.hub_vendors.find_one({"vendor_id": cart.get("vendor_id")}, {"_id": 0})
-            enriched_items = []
-            for item in cart.get("items", []):
-                product = await db.products.find_one({"product_id": item["product_id"]}, {"_id": 0})
-                if product:
-                    enriched_items.append({**item, "product": product})
-            cart["items"] = enriched_items
-            cart["vendor"] = vendor
-            enriched_carts.append(cart)
-        return enriched_carts
+        await enrich_carts(carts, include_vendor=True)
+        return carts
 
 @api_router.get("/cart/summary")
 async def get_cart_summary(current_user: User = Depends(require_auth)):
     """Get summary of all carts (vendor_id and item count)"""
-    carts = await db.carts.find({"user_id": current_user.user_id}, {"_id": 0}).to_list(100)
-    summary = {}
-    for cart in carts:
-        vendor_id = cart.get("vendor_id")
-        if vendor_id:
-            total_items = sum(item.get("quantity", 0) for item in cart.get("items", []))
-            summary[vendor_id] = total_items
-    return summary
+    await cart_write_behind.flush(current_user.user_id)
+    # Covered by the (user_id, vendor_id, item_count) index: no cart documents are fetched
+    carts = await db.carts.find(
+        {"user_id": current_user.user_id},
+        {"_id": 0, "vendor_id": 1, "item_count": 1}
+    ).to_list(100)
+    return {cart["vendor_id"]: cart.get("item_count", 0) for cart in carts if cart.get("vendor_id")}
+
+# Every cart write recomputes the denormalized badge count in the same atomic update
+CART_COUNT_STAGE = {"$set": {"item_count": {"$sum": "$items.quantity"}}}
+
+async def merge_duplicate_carts():
+    """Fold carts duplicated by racing upserts into one per (user_id, vendor_id), adding up quantities
+
+    Needed once before the unique carts index can be built; skipped when that index exists.
+    """
+    existing = await index_options(db.carts, [("user_id", ASCENDING), ("vendor_id", ASCENDING)])
+    if existing and existing.get("unique"):
+        return
+    groups = await db.carts.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "vendor_id": "$vendor_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ]).to_list(None)
+    for group in groups:
+        carts = await db.carts.find({"_id": {"$in": group["ids"]}}).sort("_id", 1).to_list(None)
+        items = {}
+        for cart in carts:
+            for item in cart.get("items") or []:
+                line = items.setdefault(item["product_id"], {**item, "quantity": 0})
+                line["quantity"] += item["quantity"]
+        await db.carts.update_one(
+            {"_id": carts[0]["_id"]},
+            [{"$set": {"items": {"$literal": list(items.values())}}}, CART_COUNT_STAGE]
+        )
+        await db.carts.delete_many({"_id": {"$in": [cart["_id"] for cart in carts[1:]]}})
+    if groups:
+        logger.info(f"Merged duplicate carts for {len(groups)} user/vendor pairs")
+
+async def backfill_cart_counts():
+    """Add item_count to carts written before it was maintained"""
+    result = await db.carts.update_many({"item_count": {"$exists": False}}, [CART_COUNT_STAGE])
+    if result.modified_count:
+        logger.info(f"Backfilled item_count on {result.modified_count} carts")
+
+def cart_set_quantities_pipeline(quantities: dict) -> List[dict]:
+    """Update pipeline that sets line quantities ({product_id: quantity}), dropping lines that reach 0"""
+    branches = [
+        {
+            "case": {"$eq": ["$$item.product_id", {"$literal": product_id}]},
+            "then": {"$mergeObjects": ["$$item", {"quantity": quantity}]}
+        }
+        for product_id, quantity in quantities.items()
+    ]
+    return [
+        {"$set": {"items": {"$filter": {
+            "input": {"$map": {
+                "input": {"$ifNull": ["$items", []]},
+                "as": "item",
+                "in": {"$switch": {"branches": branches, "default": "$$item"}}
+            }},
+            "as": "item",
+            "cond": {"$gt": ["$$item.quantity", 0]}
+        }}}},
+        CART_COUNT_STAGE
+    ]
+
+def cart_add_item_pipeline(product_id: str, quantity: int) -> List[dict]:
+    """Update pipeline that adds quantity to an existing line or appends a new one"""
+    product_id = {"$literal": product_id}
+    return [{"$set": {"items": {"$cond": {
+        "if": {"$in": [product_id, {"$ifNull": ["$items.product_id", []]}]},
+        "then": {"$map": {
+            "input": "$items",
+            "as": "item",
+            "in": {"$cond": {
+                "if": {"$eq": ["$$item.product_id", product_id]},
+                "then": {"$mergeObjects": ["$$item", {"quantity": {"$add": ["$$item.quantity", quantity]}}]},
+                "else": "$$item"
+            }}
+        }},
+        "else": {"$concatArrays": [
+            {"$ifNull": ["$items", []]},
+            [{"product_id": product_id, "quantity": quantity}]
+        ]}
+    }}}}, CART_COUNT_STAGE]
+
+# A product never changes vendor, so cart writes resolve it from memory after the first lookup
+PRODUCT_VENDOR_CACHE_SIZE = 100000
+product_vendor_ids = {}
+
+async def get_product_vendor_id(product_id: str) -> Optional[str]:
+    vendor_id = product_vendor_ids.get(product_id)
+    if vendor_id is None:
+        product = await db.products.find_one({"product_id": product_id}, {"_id": 0, "vendor_id": 1})
+        if not product:
+            return None
+        if len(product_vendor_ids) >= PRODUCT_VENDOR_CACHE_SIZE:
+            product_vendor_ids.clear()
+        vendor_id = product_vendor_ids[product_id] = product["vendor_id"]
+    return vendor_id
+
+# ===================== CART WRITE-BEHIND =====================
+
+# When > 0, quantity edits are held in memory and flushed this many ms after the first pending edit
+CART_WRITE_BEHIND_MS = float(os.environ.get('CART_WRITE_BEHIND_MS', '0'))
+
+class CartWriteBehind:
+    """Coalesces cart quantity edits per (user_id, vendor_id) and flushes them in one bulk_write
+
+    Reads and other writes of a user's carts call flush(user_id) first, so a worker always serves
+    its own pending edits back (read-your-writes). Flushes are serialized, so a flush also waits
+    for any write already in flight.
+    """
+
+    def __init__(self, delay_seconds: float):
+        self.delay_seconds = delay_seconds
+        self._pending = {}  # user_id -> {vendor_id -> {product_id: quantity}}
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.delay_seconds > 0
+
+    def set_quantity(self, user_id: str, vendor_id: str, product_id: str, quantity: int):
+        # A later edit to the same item replaces the earlier one
+        self._pending.setdefault(user_id, {}).setdefault(vendor_id, {})[product_id] = quantity
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay_seconds)
+        self._timer = None
+        try:
+            await self.flush()
+        except PyMongoError as e:
+            logger.error(f"Cart write-behind flush failed: {e}")
+
+    async def flush(self, user_id: Optional[str] = None):
+        """Write pending edits for one user, or for everyone"""
+        if user_id is not None and user_id not in self._pending and not self._lock.locked():
+            return
+        async with self._lock:
+            if user_id is None:
+                batch, self._pending = self._pending, {}
+            else:
+                batch = {user_id: self._pending.pop(user_id)} if user_id in self._pending else {}
+            if not batch:
+                return
+            
+            operations = []
+            for batch_user_id, carts in batch.items():
+                for vendor_id, quantities in carts.items():
+                    cart_filter = {"user_id": batch_user_id, "vendor_id": vendor_id}
+                    operations.append(UpdateOne(cart_filter, cart_set_quantities_pipeline(quantities)))
+                    if any(quantity <= 0 for quantity in quantities.values()):
+                        operations.append(DeleteOne({**cart_filter, "items": {"$size": 0}}))
+            try:
+                await db.carts.bulk_write(operations, ordered=True)
+            except PyMongoError:
+                # Keep the edits for the next flush unless newer ones replaced them
+                for batch_user_id, carts in batch.items():
+                    for vendor_id, quantities in carts.items():
+                        pending = self._pending.setdefault(batch_user_id, {}).setdefault(vendor_id, {})
+                        self._pending[batch_user_id][vendor_id] = {**quantities, **pending}
+                if self._timer is None:
+                    self._timer = asyncio.create_task(self._flush_later())
+                raise
+
+cart_write_behind = CartWriteBehind(CART_WRITE_BEHIND_MS / 1000)
 
 @api_router.post("/cart/add")
 async def add_to_cart(item: CartItem, current_user: User = Depends(require_auth)):
     """Add item to cart (supports multi-shop carts)"""
     # Get product info
-    product = await db.products.find_one({"product_id": item.product_id}, {"_id": 0})
-    if not product:
+    vendor_id = await get_product_vendor_id(item.product_id)
+    if not vendor_id:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    vendor_id = product["vendor_id"]
-    
-    # Get or create cart for this vendor
-    cart = await db.carts.find_one({"user_id": current_user.user_id, "vendor_id": vendor_id})
+    await cart_write_behind.flush(current_user.user_id)
     
-    if not cart:
-        # Create new cart for this vendor
-        cart = {
-            "user_id": current_user.user_id,
-            "vendor_id": vendor_id,
-            "items": [{"product_id": item.product_id, "quantity": item.quantity}]
-        }
-        await db.carts.insert_one(cart)
-    else:
-        # Check if product already in cart
-        existing_item = next((i for i in cart.get("items", []) if i["product_id"] == item.product_id), None)
-        
-        if existing_item:
-            # Update quantity
-            await db.carts.update_one(
-                {"user_id": current_user.user_id, "vendor_id": vendor_id, "items.product_id": item.product_id},
-                {"$inc": {"items.$.quantity": item.quantity}}
-            )
-        else:
-            # Add new item
-            await db.carts.update_one(
+    # Create the cart or add to it in one atomic upsert; the unique (user_id, vendor_id) index
+    # turns a concurrent first insert into a duplicate key error, which is retried as an update
+    for attempt in range(2):
+        try:
+            updated_cart = await db.carts.find_one_and_update(
                 {"user_id": current_user.user_id, "vendor_id": vendor_id},
-                {"$push": {"items": {"product_id": item.product_id, "quantity": item.quantity}}}
+                cart_add_item_pipeline(item.product_id, item.quantity),
+                projection={"_id": 0, "item_count": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
+            break
+        except DuplicateKeyError:
+            if attempt:
+                raise
     
-    # Get updated cart count
-    updated_cart = await db.carts.find_one({"user_id": current_user.user_id, "vendor_id": vendor_id})
-    total_items = sum(i.get("quantity", 0) for i in updated_cart.get("items", []))
-    
-    return {"message": "Item added to cart", "cart_count": total_items, "vendor_id": vendor_id}
+    return {"message": "Item added to cart", "cart_count": updated_cart["item_count"], "vendor_id": vendor_id}
 
 @api_router.put("/cart/update")
 async def update_cart_item(item: CartUpdate, current_user: User = Depends(require_auth)):
     """Update cart item quantity"""
     # Get product to find vendor
-    product = await db.products.find_one({"product_id": item.product_id}, {"_id": 0})
-    if not product:
+    vendor_id = await get_product_vendor_id(item.product_id)
+    if not vendor_id:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    vendor_id = product["vendor_id"]
+    if cart_write_behind.enabled:
+        cart_write_behind.set_quantity(current_user.user_id, vendor_id, item.product_id, item.quantity)
+        return {"message": "Cart updated"}
     
+    # Set the quantity (a quantity of 0 or less removes the item) and recount in one update
+    await db.carts.update_one(
+        {"user_id": current_user.user_id, "vendor_id": vendor_id},
+        cart_set_quantities_pipeline({item.product_id: item.quantity})
+    )
     if item.quantity <= 0:
-        # Remove item
-        await db.carts.update_one(
-            {"user_id": current_user.user_id, "vendor_id": vendor_id},
-            {"$pull": {"items": {"product_id": item.product_id}}}
-        )
-        # Check if cart is empty and delete if so
-        cart = await db.carts.find_one({"user_id": current_user.user_id, "vendor_id": vendor_id})
-        if cart and len(cart.get("items", [])) == 0:
-            await db.carts.delete_one({"user_id": current_user.user_id, "vendor_id": vendor_id})
-    else:
-        await db.carts.update_one(
-            {"user_id": current_user.user_id, "vendor_id": vendor_id, "items.product_id": item.product_id},
-            {"$set": {"items.$.quantity": item.quantity}}
-        )
+        # Delete the cart if that emptied it
+        await db.carts.delete_one({"user_id": current_user.user_id, "vendor_id": vendor_id, "items": {"$size": 0}})
     return {"message": "Cart updated"}
 
 @api_router.delete("/cart/clear")
 async def clear_cart(vendor_id: Optional[str] = None, current_user: User = Depends(require_auth)):
     """Clear cart for a specific vendor or all carts"""
+    await cart_write_behind.flush(current_user.user_id)
     if vendor_id:
         await db.carts.delete_one({"user_id": current_user.user_id, "vendor_id": vendor_id})
     else:
         await db.carts.delete_many({"user_id": current_user.user_id})
     return {"message": "Cart cleared"}
 
+# ===================== TRANSACTIONS & IDEMPOTENCY =====================
+
+# Multi-document transactions need a replica set or mongos; detected at startup
+transactions_supported = False
+
+async def detect_transaction_support() -> bool:
+    hello = await client.admin.command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+async def run_transaction(callback):
+    """Run callback(session) in a multi-document transaction (retried on transient errors),
+    or with session=None when the server cannot run transactions"""
+    if not transactions_supported:
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+async def claim_idempotency_key(user_id: str, key: str) -> Optional[dict]:
+    """Reserve key for this request; returns the stored response if it already completed
+
+    A claim is a lease: once locked_until passes, the request holding it is presumed dead and a retry takes over.
+    """
+    now = datetime.now(timezone.utc)
+    locked_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.idempotency_keys.insert_one({
+            "user_id": user_id,
+            "key": key,
+            "status": "in_progress",
+            "locked_until": locked_until,
+            "created_at": now
+        })
+        return None
+    except DuplicateKeyError:
+        taken_over = await db.idempotency_keys.find_one_and_update(
+            {"user_id": user_id, "key": key, "status": "in_progress", "locked_until": {"$not": {"$gt": now}}},
+            {"$set": {"locked_until": locked_until}}
+        )
+        if taken_over:
+            return None
+        existing = await db.idempotency_keys.find_one({"user_id": user_id, "key": key}, {"_id": 0})
+        if existing and existing["status"] == "completed":
+            return existing["response"]
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+async def complete_idempotency_key(user_id: str, key: str, response: dict):
+    await db.idempotency_keys.update_one(
+        {"user_id": user_id, "key": key},
+        {"$set": {"status": "completed", "response": response}, "$unset": {"locked_until": ""}}
+    )
+
+async def release_idempotency_key(user_id: str, key: str):
+    """Forget a failed request so a retry executes again"""
+    await db.idempotency_keys.delete_one({"user_id": user_id, "key": key, "status": "in_progress"})
+
+# ===================== STOCK =====================
+
+STOCK_RESERVATION_MINUTES = float(os.environ.get('STOCK_RESERVATION_MINUTES', '10'))
+STOCK_RESERVATION_SWEEP_SECONDS = float(os.environ.get('STOCK_RESERVATION_SWEEP_SECONDS', '30'))
+
+class OutOfStock(Exception):
+    """Raised inside an order or reservation write when a line cannot be covered by stock"""
+
+def line_quantities(lines) -> dict:
+    """{product_id: total quantity} for [{product_id, quantity}] lines"""
+    quantities = {}
+    for line in lines or ():
+        if line["quantity"] > 0:
+            quantities[line["product_id"]] = quantities.get(line["product_id"], 0) + line["quantity"]
+    return quantities
+
+async def restock(quantities: dict, session=None):
+    if quantities:
+        await db.products.bulk_write(
+            [UpdateOne({"product_id": pid}, {"$inc": {"stock": qty}}) for pid, qty in quantities.items()],
+            ordered=False,
+            session=session
+        )
+
+async def decrement_stock(quantities: dict, session=None) -> bool:
+    """Take stock for every line or for none; each line is a conditional $inc guarded by stock >= qty"""
+    if not quantities:
+        return True
+    if session is not None:
+        # One bulk_write; a short line leaves the transaction to be aborted by the caller
+        result = await db.products.bulk_write(
+            [
+                UpdateOne({"product_id": pid, "stock": {"$gte": qty}}, {"$inc": {"stock": -qty}})
+                for pid, qty in quantities.items()
+            ],
+            ordered=False,
+            session=session
+        )
+        return result.modified_count == len(quantities)
+    
+    # Without a transaction, each line's outcome is needed to put back exactly what was taken
+    product_ids = list(quantities)
+    results = await asyncio.gather(*[
+        db.products.update_one({"product_id": pid, "stock": {"$gte": quantities[pid]}}, {"$inc": {"stock": -quantities[pid]}})
+        for pid in product_ids
+    ])
+    if all(r.modified_count for r in results):
+        return True
+    await restock({pid: quantities[pid] for pid, r in zip(product_ids, results) if r.modified_count})
+    return False
+
+async def take_stock(needed: dict, held: dict, session=None):
+    """Move from the held (reserved) quantities to the needed ones; raises OutOfStock and takes nothing if short"""
+    delta = {pid: needed.get(pid, 0) - held.get(pid, 0) for pid in set(needed) | set(held)}
+    if not await decrement_stock({pid: d for pid, d in delta.items() if d > 0}, session):
+        if session is None:
+            # The claimed reservation is released rather than left dangling
+            await restock(held)
+        raise OutOfStock()
+    await restock({pid: -d for pid, d in delta.items() if d < 0}, session)
+
+async def out_of_stock_names(quantities: dict, products: dict) -> str:
+    """Names of the lines current stock cannot cover, for error messages"""
+    docs = await db.products.find(
+        {"product_id": {"$in": list(quantities)}},
+        {"_id": 0, "product_id": 1, "stock": 1}
+    ).to_list(None)
+    stock = {d["product_id"]: d.get("stock", 0) for d in docs}
+    return ", ".join(
+        products[pid]["name"] for pid, qty in quantities.items() if stock.get(pid, 0) < qty and pid in products
+    )
+
+async def claim_reservation(user_id: str, vendor_id: str, session=None, live_only: bool = True) -> dict:
+    """Atomically take a user's reservation for a vendor; returns its {product_id: quantity}"""
+    query = {"user_id": user_id, "vendor_id": vendor_id}
+    if live_only:
+        query["expires_at"] = {"$gt": datetime.now(timezone.utc)}
+    reservation = await db.stock_reservations.find_one_and_delete(query, session=session)
+    return line_quantities(reservation["items"]) if reservation else {}
+
+async def sweep_expired_reservations():
+    """Return stock held by abandoned checkouts; find_one_and_delete makes each claim exclusive"""
+    while True:
+        await asyncio.sleep(STOCK_RESERVATION_SWEEP_SECONDS)
+        try:
+            while True:
+                reservation = await db.stock_reservations.find_one_and_delete(
+                    {"expires_at": {"$lte": datetime.now(timezone.utc)}}
+                )
+                if not reservation:
+                    break
+                await restock(line_quantities(reservation["items"]))
+        except PyMongoError as e:
+            logger.error(f"Reservation sweep error: {e}")
+
+# ===================== AGENT LOCATIONS =====================
+
+AGENT_LOCATION_FLUSH_SECONDS = float(os.environ.get('AGENT_LOCATION_FLUSH_SECONDS', '2'))
+AGENT_LOCATION_RETENTION_SECONDS = float(os.environ.get('AGENT_LOCATION_RETENTION_SECONDS', '3600'))
+
+# Route trails are stored as Binary chunks of zigzag varints: per point the change in
+# latitude and longitude (microdegrees) and timestamp (seconds) from the previous point.
+# Each chunk starts from zero, so chunks decode independently and appending is a plain $push.
+
+def _put_varint(out: bytearray, value: int):
+    value = (value << 1) ^ (value >> 63)  # zigzag, so small negative deltas stay short
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encode_trail(points: List[tuple]) -> bytes:
+    """Pack (lat, lng, unix_seconds) points into a delta-encoded varint chunk"""
+    out = bytearray()
+    prev = (0, 0, 0)
+    for lat, lng, ts in points:
+        current = (round(lat * 1_000_000), round(lng * 1_000_000), int(ts))
+        for value, before in zip(current, prev):
+            _put_varint(out, value - before)
+        prev = current
+    return bytes(out)
+
+def decode_trail(data: bytes) -> List[tuple]:
+    """Unpack a chunk written by encode_trail back into (lat, lng, unix_seconds) points"""
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append((value >> 1) ^ -(value & 1))
+            value = shift = 0
+    points = []
+    lat = lng = ts = 0
+    for i in range(0, len(values) - 2, 3):
+        lat += values[i]
+        lng += values[i + 1]
+        ts += values[i + 2]
+        points.append((lat / 1_000_000, lng / 1_000_000, ts))
+    return points
+
+def agent_location_update(entry: dict) -> List[dict]:
+    """agent_locations update pipeline that only moves the stored position forward in time,
+    so a worker flushing an older ping cannot overwrite a newer one from another worker"""
+    is_newer = {"$gte": [entry["updated_at"], {"$ifNull": ["$updated_at", datetime.min]}]}
+    return [{"$set": {
+        "location": {"$cond": [is_newer, {"$literal": entry["location"]}, "$location"]},
+        "updated_at": {"$cond": [is_newer, entry["updated_at"], "$updated_at"]}
+    }}]
+
+class AgentLocationStore:
+    """Latest agent position per order, held in memory and flushed in bulk to the slim agent_locations collection
+
+    GPS pings only replace the in-memory entry, so any number of pings between flushes costs one write.
+    Each ping with coordinates is also queued for the order's route trail in agent_trails.
+    """
+
+    def __init__(self):
+        self._latest = {}  # order_id -> {"location": ..., "updated_at": ...}
+        self._dirty = set()
+        self._trail = {}  # order_id -> [(lat, lng, unix_seconds)] not yet appended to agent_trails
+
+    def update(self, order_id: str, location: dict, updated_at: Optional[datetime] = None):
+        updated_at = updated_at or datetime.now(timezone.utc)
+        current = self._latest.get(order_id)
+        # Replayed batches can arrive after newer live pings
+        if current is None or current["updated_at"] <= updated_at:
+            self._latest[order_id] = {"location": location, "updated_at": updated_at}
+            self._dirty.add(order_id)
+        lat, lng = location.get("lat"), location.get("lng")
+        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+            self._trail.setdefault(order_id, []).append((lat, lng, updated_at.timestamp()))
+
+    def get(self, order_id: str) -> Optional[dict]:
+        return self._latest.get(order_id)
+
+    def pending_trail(self, order_id: str) -> List[tuple]:
+        return sorted(self._trail.get(order_id, []), key=lambda point: point[2])
+
+    async def flush(self):
+        if not self._dirty and not self._trail:
+            return
+        dirty, self._dirty = self._dirty, set()
+        trail, self._trail = self._trail, {}
+        try:
+            if dirty:
+                await db.agent_locations.bulk_write([
+                    UpdateOne({"order_id": order_id}, agent_location_update(self._latest[order_id]), upsert=True)
+                    for order_id in dirty
+                ], ordered=False)
+            if trail:
+                now = datetime.now(timezone.utc)
+                await db.agent_trails.bulk_write([
+                    UpdateOne(
+                        {"order_id": order_id},
+                        {
+                            "$push": {"chunks": Binary(encode_trail(sorted(points, key=lambda point: point[2])))},
+                            "$inc": {"point_count": len(points)},
+                            "$set": {"updated_at": now}
+                        },
+                        upsert=True
+                    )
+                    for order_id, points in trail.items()
+                ], ordered=False)
+        except PyMongoError:
+            # Re-queue everything; a trail chunk written before the failure may be appended twice
+            self._dirty |= dirty
+            for order_id, points in trail.items():
+                self._trail.setdefault(order_id, [])[:0] = points
+            raise
+        
+        # Orders whose agent stopped pinging are served from agent_locations from now on
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=AGENT_LOCATION_RETENTION_SECONDS)
+        for order_id in [o for o, entry in self._latest.items() if entry["updated_at"] < cutoff and o not in self._dirty]:
+            del self._latest[order_id]
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(AGENT_LOCATION_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.error(f"Agent location flush error: {e}")
+
+agent_location_store = AgentLocationStore()
+
+async def get_agent_trail(order_id: str) -> List[tuple]:
+    """Full route trail of an order, flushed and this worker's pending points, in time order"""
+    doc = await db.agent_trails.find_one({"order_id": order_id}, {"_id": 0, "chunks": 1})
+    points = [point for chunk in (doc or {}).get("chunks", []) for point in decode_trail(chunk)]
+    # A replayed offline queue lands in a later chunk than the live pings it predates
+    points.extend(agent_location_store.pending_trail(order_id))
+    points.sort(key=lambda point: point[2])
+    return points
+
+async def get_agent_location(order_id: str) -> Optional[dict]:
+    """Latest known agent location, from this worker's memory or the last flushed position, whichever is newer
+
+    A ping younger than one flush interval is served from memory without a read; anything older may have
+    been superseded by a ping another worker has since flushed.
+    """
+    entry = agent_location_store.get(order_id)
+    if entry is not None and entry["updated_at"] > datetime.now(timezone.utc) - timedelta(seconds=AGENT_LOCATION_FLUSH_SECONDS):
+        return entry["location"]
+    
+    stored = await db.agent_locations.find_one({"order_id": order_id}, {"_id": 0, "location": 1, "updated_at": 1})
+    if stored is None:
+        return entry["location"] if entry else None
+    if entry is not None:
+        stored_at = stored["updated_at"]
+        if stored_at.tzinfo is None:
+            stored_at = stored_at.replace(tzinfo=timezone.utc)
+        if entry["updated_at"] >= stored_at:
+            return entry["location"]
+    return stored["location"]
+
 # ===================== SHOP ORDER ENDPOINTS =====================
 
 class OrderCreate(BaseModel):
@@ -793,15 +2687,47 @@ class OrderCreate(BaseModel):
     notes: Optional[str] = None
 
 @api_router.post("/orders")
-async def create_order(order_data: OrderCreate, current_user: User = Depends(require_auth)):
-    """Create an order from cart for a specific vendor"""
+async def create_order(
+    order_data: OrderCreate,
+    current_user: User = Depends(require_auth),
+    idempotency_key: Optional[str] = Header(default=None)
+):
+    """Create an order from cart for a specific vendor
+
+    A replay with the same Idempotency-Key header returns the stored response without placing another order.
+    """
+    if not idempotency_key:
+        return await place_order(order_data, current_user)
+    
+    stored_response = await claim_idempotency_key(current_user.user_id, idempotency_key)
+    if stored_response is not None:
+        return stored_response
+    try:
+        response = await place_order(order_data, current_user)
+    except BaseException:
+        # Cancellation included; if the release itself fails the lease expires instead
+        try:
+            await release_idempotency_key(current_user.user_id, idempotency_key)
+        except PyMongoError as e:
+            logger.error(f"Idempotency key release failed: {e}")
+        raise
+    try:
+        await complete_idempotency_key(current_user.user_id, idempotency_key, response)
+    except PyMongoError as e:
+        # The order is placed; a retry after the lease finds the cart already cleared
+        logger.error(f"Idempotency key completion failed: {e}")
+    return response
+
+async def place_order(order_data: OrderCreate, current_user: User) -> dict:
+    await cart_write_behind.flush(current_user.user_id)
+    
     # Get cart for specific vendor
     cart = await db.carts.find_one({"user_id": current_user.user_id, "vendor_id": order_data.vendor_id})
     if not cart or not cart.get("items"):
         raise HTTPException(status_code=400, detail="Cart is empty for this vendor")
     
     # Get vendor
-    vendor = await db.hub_vendors.find_one({"vendor_id": order_data.vendor_id}, {"_id": 0})
+    vendor = await db.hub_vendors.find_one({"vendor_id": order_data.vendor_id}, VENDOR_PROJECTION)
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
     
@@ -809,8 +2735,9 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(req
     items = []
     total_amount = 0
     
+    products = await load_products(cart_item["product_id"] for cart_item in cart["items"])
     for cart_item in cart["items"]:
-        product = await db.products.find_one({"product_id": cart_item["product_id"]}, {"_id": 0})
+        product = products.get(cart_item["product_id"])
         if product:
             price = product.get("discounted_price") or product["price"]
             item_total = price * cart_item["quantity"]
@@ -869,9 +2796,8 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(req
         "created_at": datetime.now(timezone.utc)
     }
     
-    await db.shop_orders.insert_one(order)
-    
     # If agent delivery, create a delivery wish
+    delivery_wish = None
     if order_data.delivery_type == "agent_delivery":
         delivery_wish = {
             "wish_id": f"wish_{uuid.uuid4().hex[:12]}",
@@ -890,10 +2816,49 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(req
             "accepted_by": None,
             "created_at": datetime.now(timezone.utc)
         }
-        await db.wishes.insert_one(delivery_wish)
     
-    # Clear cart for this vendor only
-    await db.carts.delete_one({"user_id": current_user.user_id, "vendor_id": order_data.vendor_id})
+    quantities = line_quantities(items)
+    
+    async def write_order(session):
+        # Stock comes from the checkout reservation where one is held, the rest is taken now
+        held = await claim_reservation(current_user.user_id, order_data.vendor_id, session)
+        await take_stock(quantities, held, session)
+        
+        cart_removed = order_inserted = False
+        try:
+            # Clear cart for this vendor only, and only if it still holds what was priced
+            cleared = await db.carts.delete_one(
+                {"user_id": current_user.user_id, "vendor_id": order_data.vendor_id, "items": cart["items"]},
+                session=session
+            )
+            if cleared.deleted_count == 0:
+                raise HTTPException(status_code=409, detail="Cart changed while placing the order, please retry")
+            cart_removed = True
+            await db.shop_orders.insert_one(order, session=session)
+            order_inserted = True
+            if delivery_wish:
+                await db.wishes.insert_one(delivery_wish, session=session)
+        except Exception:
+            if session is None:
+                # No transaction to abort, so stock, cart and order are put back by hand
+                try:
+                    await restock(quantities)
+                    if order_inserted:
+                        await db.shop_orders.delete_one({"order_id": order["order_id"]})
+                    if cart_removed:
+                        await db.carts.insert_one(cart)
+                except DuplicateKeyError:
+                    pass  # the user already started a new cart for this vendor
+                except PyMongoError as e:
+                    logger.error(f"Rolling back order {order['order_id']} failed: {e}")
+            raise
+    
+    # Stock, cart removal, order and delivery wish commit together
+    try:
+        await run_transaction(write_order)
+    except OutOfStock:
+        names = await out_of_stock_names(quantities, products)
+        raise HTTPException(status_code=409, detail=f"Not enough stock for: {names or 'some items'}")
     
     # Remove MongoDB _id before returning
     order.pop("_id", None)
@@ -908,6 +2873,56 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(req
         "order": order
     }
 
+class ReservationCreate(BaseModel):
+    vendor_id: str
+
+@api_router.post("/orders/reserve")
+async def reserve_stock(reservation_data: ReservationCreate, current_user: User = Depends(require_auth)):
+    """Hold stock for the cart of a vendor while the user is at checkout"""
+    await cart_write_behind.flush(current_user.user_id)
+    
+    cart = await db.carts.find_one(
+        {"user_id": current_user.user_id, "vendor_id": reservation_data.vendor_id},
+        {"_id": 0, "items": 1}
+    )
+    if not cart or not cart.get("items"):
+        raise HTTPException(status_code=400, detail="Cart is empty for this vendor")
+    
+    products = await load_products(item["product_id"] for item in cart["items"])
+    quantities = line_quantities(item for item in cart["items"] if item["product_id"] in products)
+    reservation = {
+        "reservation_id": f"res_{uuid.uuid4().hex[:12]}",
+        "user_id": current_user.user_id,
+        "vendor_id": reservation_data.vendor_id,
+        "items": [{"product_id": pid, "quantity": qty} for pid, qty in quantities.items()],
+        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=STOCK_RESERVATION_MINUTES),
+        "created_at": datetime.now(timezone.utc)
+    }
+    
+    async def write_reservation(session):
+        # A previous reservation (even an expired one the sweeper has not reached) is replaced
+        held = await claim_reservation(current_user.user_id, reservation_data.vendor_id, session, live_only=False)
+        await take_stock(quantities, held, session)
+        await db.stock_reservations.insert_one(reservation, session=session)
+    
+    try:
+        await run_transaction(write_reservation)
+    except OutOfStock:
+        names = await out_of_stock_names(quantities, products)
+        raise HTTPException(status_code=409, detail=f"Not enough stock for: {names or 'some items'}")
+    
+    reservation.pop("_id", None)
+    reservation["expires_at"] = reservation["expires_at"].isoformat()
+    reservation["created_at"] = reservation["created_at"].isoformat()
+    return reservation
+
+@api_router.delete("/orders/reserve/{vendor_id}")
+async def release_stock_reservation(vendor_id: str, current_user: User = Depends(require_auth)):
+    """Give back stock held for checkout"""
+    held = await claim_reservation(current_user.user_id, vendor_id, live_only=False)
+    await restock(held)
+    return {"message": "Reservation released"}
+
 @api_router.get("/orders")
 async def get_orders(current_user: User = Depends(require_auth)):
     """Get user's orders with vendor details"""
@@ -927,6 +2942,11 @@ async def get_order_details(order_id: str, current_user: User = Depends(require_
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
+    # Live position is kept out of the order document
+    agent_location = await get_agent_location(order_id)
+    if agent_location:
+        order["agent_location"] = agent_location
+    
     # Get linked delivery wish if exists
     delivery_wish = await db.wishes.find_one(
         {"linked_order_id": order_id},
@@ -937,49 +2957,155 @@ async def get_order_details(order_id: str, current_user: User = Depends(require_
     
     return order
 
+ORDER_STREAM_HEARTBEAT_SECONDS = float(os.environ.get('ORDER_STREAM_HEARTBEAT_SECONDS', '15'))
+
+@api_router.get("/orders/{order_id}/stream")
+async def stream_order(order_id: str, request: Request, current_user: User = Depends(require_auth)):
+    """Server-Sent Events for order tracking: a snapshot, then status, location and ETA changes"""
+    # Subscribe before reading the snapshot so nothing published in between is missed
+    subscription = event_hub.subscribe(f"order:{order_id}")
+    order = await db.shop_orders.find_one(
+        {"order_id": order_id, "user_id": current_user.user_id},
+        {"_id": 0, "status": 1, "estimated_delivery": 1, "agent_location": 1}
+    )
+    if not order:
+        subscription.close()
+        raise HTTPException(status_code=404, detail="Order not found")
+    agent_location = await get_agent_location(order_id)
+    if agent_location:
+        order["agent_location"] = agent_location
+    
+    async def events():
+        try:
+            yield sse_event("snapshot", order)
+            while not await request.is_disconnected():
+                event = await subscription.get(ORDER_STREAM_HEARTBEAT_SECONDS)
+                if subscription.lagged:
+                    # The client reconnects and starts again from a fresh snapshot
+                    yield sse_event("lagged", {})
+                    break
+                if event is None:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield sse_event(event["type"], event["data"])
+        finally:
+            subscription.close()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Status -> statuses it may move to; anything else, including going backwards, is rejected
+ORDER_STATUS_TRANSITIONS = {
+    "confirmed": ["preparing", "cancelled"],
+    "preparing": ["ready", "cancelled"],
+    "ready": ["picked_up", "on_the_way", "cancelled"],
+    "picked_up": ["on_the_way"],
+    "on_the_way": ["nearby", "delivered"],
+    "nearby": ["delivered"],
+    "delivered": [],
+    "cancelled": [],
+}
+
+def previous_order_statuses(status: str) -> List[str]:
+    """Statuses an order may be in to move to status"""
+    return [s for s, next_statuses in ORDER_STATUS_TRANSITIONS.items() if status in next_statuses]
+
 @api_router.put("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status: str, agent_location: Optional[dict] = None):
+async def update_order_status(
+    order_id: str,
+    status: str,
+    agent_location: Optional[dict] = None,
+    estimated_delivery: Optional[str] = None
+):
     """Update order status (for vendors/agents)"""
-    valid_statuses = ["confirmed", "preparing", "ready", "picked_up", "on_the_way", "nearby", "delivered", "cancelled"]
-    if status not in valid_statuses:
+    if status not in ORDER_STATUS_TRANSITIONS:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    update_data = {
+    history_entry = {
         "status": status,
-        "$push": {
-            "status_history": {
-                "status": status,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "message": f"Order {status.replace('_', ' ')}"
-            }
-        }
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "message": f"Order {status.replace('_', ' ')}"
     }
-    
-    if agent_location:
-        update_data["agent_location"] = agent_location
-    
-    await db.shop_orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"status": status, "agent_location": agent_location} if agent_location else {"$set": {"status": status}}}
-    )
-    
-    # Also push to status history
-    await db.shop_orders.update_one(
-        {"order_id": order_id},
-        {"$push": {"status_history": {"status": status, "timestamp": datetime.now(timezone.utc).isoformat()}}}
+    update_data = {
+        "$set": {"status": status},
+        "$push": {"status_history": history_entry}
+    }
+    if estimated_delivery:
+        update_data["$set"]["estimated_delivery"] = estimated_delivery
+    # Status and history change together, and only from a status allowed to move here,
+    # so concurrent vendor and agent updates cannot regress an order
+    order = await db.shop_orders.find_one_and_update(
+        {"order_id": order_id, "status": {"$in": previous_order_statuses(status)}},
+        update_data,
+        projection={"_id": 0, "items": 1}
     )
+    if not order:
+        current = await db.shop_orders.find_one({"order_id": order_id}, {"_id": 0, "status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if current["status"] == status:
+            # A retried transition that already happened
+            return {"message": f"Order status updated to {status}"}
+        raise HTTPException(status_code=409, detail=f"Cannot change order status from {current['status']} to {status}")
+    
+    topic = f"order:{order_id}"
+    event_hub.publish(topic, "status", history_entry)
+    if estimated_delivery:
+        event_hub.publish(topic, "eta", {"estimated_delivery": estimated_delivery})
+    if agent_location:
+        agent_location_store.update(order_id, agent_location)
+        event_hub.publish(topic, "agent_location", agent_location)
+    if status == "cancelled":
+        await restock(line_quantities(order.get("items")))
     
     return {"message": f"Order status updated to {status}"}
 
 @api_router.put("/orders/{order_id}/agent-location")
 async def update_agent_location(order_id: str, location: dict):
     """Update delivery agent's live location"""
-    await db.shop_orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"agent_location": location}}
-    )
+    agent_location_store.update(order_id, location)
+    event_hub.publish(f"order:{order_id}", "agent_location", location)
     return {"message": "Location updated"}
 
+class AgentLocationPoint(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+    timestamp: datetime
+
+class AgentLocationBatch(BaseModel):
+    points: List[AgentLocationPoint] = Field(min_length=1, max_length=1000)
+
+@api_router.post("/orders/{order_id}/agent-location/batch")
+async def upload_agent_locations(order_id: str, batch: AgentLocationBatch):
+    """Upload GPS points queued by the agent app while offline"""
+    for point in sorted(batch.points, key=lambda p: p.timestamp):
+        timestamp = point.timestamp if point.timestamp.tzinfo else point.timestamp.replace(tzinfo=timezone.utc)
+        agent_location_store.update(order_id, {"lat": point.lat, "lng": point.lng}, timestamp)
+    # Trackers only need where the agent is now, not the replayed path
+    latest = agent_location_store.get(order_id)
+    if latest:
+        event_hub.publish(f"order:{order_id}", "agent_location", latest["location"])
+    return {"message": "Locations recorded", "count": len(batch.points)}
+
+@api_router.get("/orders/{order_id}/agent-trail")
+async def get_order_agent_trail(order_id: str, current_user: User = Depends(require_auth)):
+    """Get the delivery agent's route history for an order"""
+    order = await db.shop_orders.find_one({"order_id": order_id, "user_id": current_user.user_id}, {"_id": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    points = await get_agent_trail(order_id)
+    return {
+        "order_id": order_id,
+        "points": [
+            {"lat": lat, "lng": lng, "timestamp": datetime.fromtimestamp(ts, timezone.utc).isoformat()}
+            for lat, lng, ts in points
+        ]
+    }
+
 # ===================== SEED DATA =====================
 
 @api_router.post("/seed")
@@ -1246,11 +3372,13 @@ async def seed_hub_vendors():
     
     # Insert vendors
     for vendor in hub_vendors:
+        vendor["geo"] = vendor_geo_point(vendor["location"])
         await db.hub_vendors.update_one(
             {"vendor_id": vendor["vendor_id"]},
             {"$set": vendor},
             upsert=True
         )
+        on_vendor_changed(vendor)
     
     # Insert products
     for product in products:
@@ -1438,14 +3566,8 @@ async def seed_chat_data(current_user: User = Depends(require_auth)):
     # Insert chat rooms and messages
     for chat in chat_data:
         room = chat["room"]
-        await db.chat_rooms.update_one(
-            {"room_id": room["room_id"]},
-            {"$set": room},
-            upsert=True
-        )
-        
-        for idx, msg in enumerate(chat["messages"]):
-            message = {
+        messages = [
+            {
                 "message_id": f"msg_demo_{uuid.uuid4().hex[:8]}",
                 "room_id": room["room_id"],
                 "sender_id": room["agent_id"] if msg["sender"] == "agent" else user_id,
@@ -1453,7 +3575,27 @@ async def seed_chat_data(current_user: User = Depends(require_auth)):
                 "content": msg["content"],
                 "created_at": datetime.now(timezone.utc) + timedelta(minutes=msg["time_offset"])
             }
-            await db.messages.insert_one(message)
+            for msg in chat["messages"]
+        ]
+        await db.messages.insert_many(messages)
+        
+        # Agent messages after the wisher's last reply are unread
+        unread = 0
+        for message in reversed(messages):
+            if message["sender_type"] == "wisher":
+                break
+            unread += 1
+        last_message = {k: v for k, v in messages[-1].items() if k != "_id"}
+        room.update({
+            "last_message": last_message,
+            "last_message_at": last_message["created_at"],
+            "unread": {user_id: unread, room["agent_id"]: 0}
+        })
+        await db.chat_rooms.update_one(
+            {"room_id": room["room_id"]},
+            {"$set": room},
+            upsert=True
+        )
     
     return {
         "message": "Chat data seeded successfully!",
@@ -1483,6 +3625,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Long-running tasks started at startup, cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_tasks():
+    global auth_http_client, transactions_supported
+    auth_http_client = create_auth_http_client()
+    
+    await ensure_indexes()
+    await purge_expired_sessions()
+    try:
+        transactions_supported = await detect_transaction_support()
+    except PyMongoError as e:
+        logger.error(f"Transaction support check failed: {e}")
+    logger.info(f"Multi-document transactions {'enabled' if transactions_supported else 'unavailable (standalone server)'}")
+    try:
+        await backfill_vendor_geo()
+    except PyMongoError as e:
+        logger.error(f"Vendor geo backfill failed: {e}")
+    try:
+        await backfill_cart_counts()
+    except PyMongoError as e:
+        logger.error(f"Cart count backfill failed: {e}")
+    try:
+        await backfill_chat_room_activity()
+    except PyMongoError as e:
+        logger.error(f"Chat room backfill failed: {e}")
+    
+    try:
+        await vendor_coverage_index.load()
+        if VENDOR_GEO_INDEX_ENABLED:
+            await vendor_geo_index.load()
+    except PyMongoError as e:
+        logger.error(f"Vendor index load failed: {e}")
+    background_tasks.append(asyncio.create_task(watch_hub_vendors()))
+    background_tasks.append(asyncio.create_task(sweep_expired_reservations()))
+    background_tasks.append(asyncio.create_task(agent_location_store.flush_loop()))
+    if EVENT_BUS_ENABLED:
+        try:
+            await event_bus.ensure_collection()
+        except PyMongoError as e:
+            logger.error(f"Event bus setup failed: {e}")
+        event_hub.bus = event_bus
+        background_tasks.append(asyncio.create_task(event_bus.write_loop()))
+        background_tasks.append(asyncio.create_task(event_bus.tail_loop()))
+    
+    if SESSION_SIGNING_SECRET:
+        await sync_revoked_sessions()
+        logger.info(f"Loaded {len(revoked_sessions)} revoked signed sessions")
+        background_tasks.append(asyncio.create_task(refresh_revoked_sessions_loop()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    try:
+        await cart_write_behind.flush()
+    except PyMongoError as e:
+        logger.error(f"Cart write-behind flush at shutdown failed: {e}")
+    try:
+        await agent_location_store.flush()
+    except PyMongoError as e:
+        logger.error(f"Agent location flush at shutdown failed: {e}")
+    await message_writer.close()
+    if auth_http_client is not None:
+        await auth_http_client.aclose()
     client.close()
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["check-indexes"]:
+        sys.exit(0 if asyncio.run(check_query_plans()) else 1)
+    print("usage: python server.py check-indexes")
+    sys.exit(2)
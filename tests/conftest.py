@@ -0,0 +1,49 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads these at import time; the Motor client does not connect until first use
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "quickwish_test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", fake)
+    return fake
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory stand-in for the Mongo database the server module talks to"""
+    from mongomock_motor import AsyncCursor, AsyncMongoMockClient
+
+    async def to_list(cursor, length=None):
+        # mongomock-motor returns every match; Motor stops at length
+        documents = [document async for document in cursor]
+        return documents if length is None else documents[:length]
+
+    monkeypatch.setattr(AsyncCursor, "to_list", to_list)
+    database = AsyncMongoMockClient()["quickwish_test"]
+    monkeypatch.setattr(server, "db", database)
+    return database
@@ -0,0 +1,88 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+from server import AgentLocationStore
+
+pytestmark = pytest.mark.anyio
+
+HERE = {"lat": 12.97, "lng": 77.59}
+THERE = {"lat": 12.98, "lng": 77.60}
+
+
+def ago(seconds):
+    return datetime.now(timezone.utc) - timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def store(db, monkeypatch):
+    store = AgentLocationStore()
+    monkeypatch.setattr(server, "agent_location_store", store)
+    monkeypatch.setattr(server, "AGENT_LOCATION_FLUSH_SECONDS", 2)
+    return store
+
+
+async def stored_location(db):
+    return (await db.agent_locations.find_one({"order_id": "order_1"}))["location"]
+
+
+async def test_pings_between_flushes_cost_one_write(db, store):
+    store.update("order_1", {"lat": 1, "lng": 1}, ago(3))
+    store.update("order_1", HERE, ago(2))
+    await store.flush()
+
+    assert await db.agent_locations.count_documents({}) == 1
+    assert await stored_location(db) == HERE
+
+
+async def test_older_flush_from_another_worker_does_not_win(db, store):
+    other_worker = AgentLocationStore()
+    store.update("order_1", HERE, ago(1))
+    other_worker.update("order_1", THERE, ago(10))
+
+    await store.flush()
+    await other_worker.flush()
+    assert await stored_location(db) == HERE
+
+    other_worker.update("order_1", THERE, ago(0))
+    await other_worker.flush()
+    assert await stored_location(db) == THERE
+
+
+async def test_location_is_stored_literally(db, store):
+    store.update("order_1", {"lat": 1, "lng": 1, "note": "$location"})
+    await store.flush()
+
+    assert (await stored_location(db))["note"] == "$location"
+
+
+async def test_fresh_ping_is_read_from_memory(db, store):
+    await db.agent_locations.insert_one({"order_id": "order_1", "location": THERE, "updated_at": ago(0)})
+    store.update("order_1", HERE, ago(1))
+
+    assert await server.get_agent_location("order_1") == HERE
+
+
+async def test_stale_memory_loses_to_newer_flush_from_another_worker(db, store):
+    store.update("order_1", HERE, ago(60))
+    await store.flush()
+    other_worker = AgentLocationStore()
+    other_worker.update("order_1", THERE, ago(30))
+    await other_worker.flush()
+
+    assert await server.get_agent_location("order_1") == THERE
+
+
+async def test_stale_memory_still_wins_over_older_stored_position(db, store):
+    await db.agent_locations.insert_one({"order_id": "order_1", "location": THERE, "updated_at": ago(120)})
+    store.update("order_1", HERE, ago(60))
+
+    assert await server.get_agent_location("order_1") == HERE
+
+
+async def test_location_without_memory(db, store):
+    assert await server.get_agent_location("order_1") is None
+
+    await db.agent_locations.insert_one({"order_id": "order_1", "location": THERE, "updated_at": ago(60)})
+    assert await server.get_agent_location("order_1") == THERE
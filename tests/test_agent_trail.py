@@ -0,0 +1,70 @@
+import random
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+from server import AgentLocationBatch, AgentLocationStore, encode_trail, decode_trail
+
+
+def test_trail_round_trip():
+    rng = random.Random(7)
+    points = []
+    lat, lng, ts = 12.9716, 77.5946, 1_700_000_000
+    for _ in range(500):
+        lat += rng.uniform(-0.001, 0.001)
+        lng += rng.uniform(-0.001, 0.001)
+        # Replayed offline points can go back in time
+        ts += rng.randint(-30, 60)
+        points.append((lat, lng, ts))
+
+    decoded = decode_trail(encode_trail(points))
+
+    assert len(decoded) == len(points)
+    for (lat, lng, ts), (dlat, dlng, dts) in zip(points, decoded):
+        assert dlat == pytest.approx(lat, abs=1e-6)
+        assert dlng == pytest.approx(lng, abs=1e-6)
+        assert dts == ts
+
+
+def test_trail_handles_both_hemispheres_and_large_jumps():
+    points = [(-33.8688, 151.2093, 0), (51.5074, -0.1278, 1_700_000_000), (-89.999999, -179.999999, 5)]
+    assert decode_trail(encode_trail(points)) == [(-33.8688, 151.2093, 0), (51.5074, -0.1278, 1_700_000_000), (-89.999999, -179.999999, 5)]
+
+
+def test_trail_is_compact():
+    points = [(12.9716 + i * 1e-5, 77.5946 + i * 1e-5, 1_700_000_000 + i * 5) for i in range(100)]
+    # First point carries absolute values, then about one byte per field
+    assert len(encode_trail(points)) < 20 + 99 * 4
+
+
+def test_empty_trail():
+    assert encode_trail([]) == b""
+    assert decode_trail(b"") == []
+
+
+@pytest.mark.anyio
+async def test_replayed_points_come_back_in_time_order(db, monkeypatch):
+    store = AgentLocationStore()
+    monkeypatch.setattr(server, "agent_location_store", store)
+    start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=5)
+
+    # Live pings are flushed before the agent's offline queue for the minute before arrives
+    store.update("order_1", {"lat": 12.0, "lng": 77.0}, start + timedelta(seconds=60))
+    store.update("order_1", {"lat": 12.1, "lng": 77.1}, start + timedelta(seconds=90))
+    await store.flush()
+    await server.upload_agent_locations("order_1", AgentLocationBatch(points=[
+        {"lat": 11.9, "lng": 76.9, "timestamp": start + timedelta(seconds=30)},
+        {"lat": 11.8, "lng": 76.8, "timestamp": start},
+    ]))
+
+    expected = [0, 30, 60, 90]
+    assert [ts - start.timestamp() for _, _, ts in await server.get_agent_trail("order_1")] == expected
+    await store.flush()
+    assert [ts - start.timestamp() for _, _, ts in await server.get_agent_trail("order_1")] == expected
+
+    trail = await db.agent_trails.find_one({"order_id": "order_1"})
+    assert trail["point_count"] == 4
+    assert len(trail["chunks"]) == 2
+    # The replayed batch is older than the live position, which stays current
+    assert store.get("order_1")["location"] == {"lat": 12.1, "lng": 77.1}
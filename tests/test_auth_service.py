@@ -0,0 +1,118 @@
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import CircuitBreaker
+
+
+@pytest.fixture
+def auth_service(monkeypatch):
+    """Point fetch_session_data at a scripted auth service; returns the list of statuses it saw"""
+    responses = []
+    seen = []
+
+    def handler(request):
+        status = responses.pop(0) if len(responses) > 1 else responses[0]
+        seen.append(status)
+        return httpx.Response(status, json={"id": "user_1"} if status == 200 else {})
+
+    monkeypatch.setattr(server, "auth_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(server, "auth_breaker", CircuitBreaker(failure_threshold=3, reset_seconds=30))
+    monkeypatch.setattr(server, "AUTH_RETRY_BACKOFF_SECONDS", 0)
+    return responses, seen
+
+
+def test_circuit_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+    # Concurrent callers keep failing fast while the trial call is in flight
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_failed_trial_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("status", [401, 403, 404])
+async def test_rejected_session_is_invalid_without_tripping_breaker(auth_service, status):
+    responses, seen = auth_service
+    responses.append(status)
+
+    for _ in range(5):
+        with pytest.raises(HTTPException) as error:
+            await server.fetch_session_data("session_1")
+        assert error.value.status_code == 401
+
+    assert seen == [status] * 5
+    assert server.auth_breaker.allow()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("status", [400, 429, 500])
+async def test_unexpected_status_is_a_service_error(auth_service, status):
+    responses, seen = auth_service
+    responses.append(status)
+
+    with pytest.raises(HTTPException) as error:
+        await server.fetch_session_data("session_1")
+
+    assert error.value.status_code == 500
+    assert seen == [status]
+    assert server.auth_breaker.failures == 1
+
+
+@pytest.mark.anyio
+async def test_gateway_errors_are_retried(auth_service):
+    responses, seen = auth_service
+    responses.extend([503, 502, 200])
+
+    assert await server.fetch_session_data("session_1") == {"id": "user_1"}
+    assert seen == [503, 502, 200]
+
+
+@pytest.mark.anyio
+async def test_open_breaker_fails_fast(auth_service):
+    responses, seen = auth_service
+    responses.append(500)
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            await server.fetch_session_data("session_1")
+
+    with pytest.raises(HTTPException) as error:
+        await server.fetch_session_data("session_1")
+
+    assert error.value.status_code == 503
+    assert len(seen) == 3
@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+import server
+from server import CartItem, CartUpdate, CartWriteBehind, User
+
+pytestmark = pytest.mark.anyio
+
+USER = User(user_id="user_1", email="user@example.com", name="User")
+
+
+class CartsStub:
+    """Records cart writes; the first `duplicates` upserts lose the insert race to another request"""
+
+    def __init__(self, duplicates=0):
+        self.duplicates = duplicates
+        self.upserts = []
+        self.bulk_writes = []
+        self.failures = 0
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("connection reset")
+        self.bulk_writes.append(operations)
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        self.upserts.append((filter, update, kwargs))
+        if self.duplicates:
+            self.duplicates -= 1
+            raise DuplicateKeyError("E11000 duplicate key error collection: carts index: user_id_1_vendor_id_1")
+        return {"item_count": 3}
+
+
+@pytest.fixture
+def carts(monkeypatch):
+    monkeypatch.setitem(server.product_vendor_ids, "p1", "vendor_1")
+    stub = CartsStub()
+    monkeypatch.setattr(server, "db", SimpleNamespace(carts=stub))
+    return stub
+
+
+async def test_add_is_one_atomic_upsert(carts):
+    result = await server.add_to_cart(CartItem(product_id="p1", quantity=2), USER)
+
+    assert result == {"message": "Item added to cart", "cart_count": 3, "vendor_id": "vendor_1"}
+    [(cart_filter, update, options)] = carts.upserts
+    assert cart_filter == {"user_id": "user_1", "vendor_id": "vendor_1"}
+    assert update == server.cart_add_item_pipeline("p1", 2)
+    assert options["upsert"] is True
+    assert options["return_document"] == ReturnDocument.AFTER
+
+
+async def test_lost_insert_race_is_retried_as_update(carts):
+    carts.duplicates = 1
+
+    result = await server.add_to_cart(CartItem(product_id="p1", quantity=2), USER)
+
+    assert result["cart_count"] == 3
+    assert len(carts.upserts) == 2
+
+
+async def test_repeated_duplicate_key_error_is_raised(carts):
+    carts.duplicates = 2
+
+    with pytest.raises(DuplicateKeyError):
+        await server.add_to_cart(CartItem(product_id="p1", quantity=2), USER)
+
+
+async def test_unknown_product(carts, monkeypatch):
+    async def no_product(product_id):
+        return None
+    monkeypatch.setattr(server, "get_product_vendor_id", no_product)
+
+    with pytest.raises(HTTPException) as error:
+        await server.add_to_cart(CartItem(product_id="missing", quantity=1), USER)
+
+    assert error.value.status_code == 404
+    assert carts.upserts == []
+
+
+def bare_strings(node):
+    """Every string in an update pipeline that Mongo would evaluate as an expression"""
+    if isinstance(node, dict):
+        if "$literal" in node:
+            return
+        for value in node.values():
+            yield from bare_strings(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from bare_strings(value)
+    elif isinstance(node, str):
+        yield node
+
+
+def test_pipelines_treat_product_ids_as_literals():
+    # A product_id such as "$items" must never be read as a field path
+    assert "$items.0" not in set(bare_strings(server.cart_add_item_pipeline("$items.0", 1)))
+    assert "$items.0" not in set(bare_strings(server.cart_set_quantities_pipeline({"$items.0": 1})))
+
+
+def set_quantities(user_id, vendor_id, quantities):
+    return UpdateOne({"user_id": user_id, "vendor_id": vendor_id}, server.cart_set_quantities_pipeline(quantities))
+
+
+@pytest.fixture
+def write_behind(monkeypatch):
+    writer = CartWriteBehind(0.01)
+    monkeypatch.setattr(server, "cart_write_behind", writer)
+    return writer
+
+
+async def test_edits_coalesce_into_one_bulk_write(carts, write_behind):
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 1)
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 4)
+    write_behind.set_quantity("user_1", "vendor_1", "p2", 2)
+    write_behind.set_quantity("user_2", "vendor_1", "p1", 1)
+    assert carts.bulk_writes == []
+
+    await asyncio.sleep(0.05)
+
+    assert carts.bulk_writes == [[
+        set_quantities("user_1", "vendor_1", {"p1": 4, "p2": 2}),
+        set_quantities("user_2", "vendor_1", {"p1": 1}),
+    ]]
+
+
+async def test_removal_also_deletes_emptied_cart(carts, write_behind):
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 0)
+    await write_behind.flush()
+
+    assert carts.bulk_writes == [[
+        set_quantities("user_1", "vendor_1", {"p1": 0}),
+        DeleteOne({"user_id": "user_1", "vendor_id": "vendor_1", "items": {"$size": 0}}),
+    ]]
+
+
+async def test_flush_for_one_user_leaves_others_pending(carts, write_behind):
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 1)
+    write_behind.set_quantity("user_2", "vendor_1", "p1", 2)
+
+    await write_behind.flush("user_1")
+    assert carts.bulk_writes == [[set_quantities("user_1", "vendor_1", {"p1": 1})]]
+
+    await write_behind.flush("user_3")
+    assert len(carts.bulk_writes) == 1
+
+
+async def test_failed_flush_keeps_edits_and_newer_ones_win(carts, write_behind):
+    carts.failures = 1
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 1)
+    write_behind.set_quantity("user_1", "vendor_1", "p2", 1)
+
+    with pytest.raises(AutoReconnect):
+        await write_behind.flush()
+    write_behind.set_quantity("user_1", "vendor_1", "p1", 5)
+    # The failure scheduled a retry
+    await asyncio.sleep(0.05)
+
+    assert carts.bulk_writes == [[set_quantities("user_1", "vendor_1", {"p1": 5, "p2": 1})]]
+
+
+async def test_cart_writes_read_back_pending_edits(carts, write_behind, monkeypatch):
+    monkeypatch.setattr(write_behind, "delay_seconds", 60)
+    await server.update_cart_item(CartUpdate(product_id="p1", quantity=3), USER)
+    assert carts.bulk_writes == []
+
+    await server.add_to_cart(CartItem(product_id="p1", quantity=1), USER)
+
+    # The pending edit lands before the add that builds on it
+    assert carts.bulk_writes == [[set_quantities("user_1", "vendor_1", {"p1": 3})]]
+    assert len(carts.upserts) == 1
+    write_behind._timer.cancel()
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import server
+from server import MessageWriter, User
+
+pytestmark = pytest.mark.anyio
+
+ROOM = {"room_id": "room_1", "wisher_id": "user_1", "agent_id": "agent_1"}
+WISHER = User(user_id="user_1", email="wisher@example.com", name="Wisher")
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = MessageWriter()
+    monkeypatch.setattr(server, "message_writer", writer)
+    return writer
+
+
+@pytest.fixture
+async def room(db):
+    await db.chat_rooms.insert_one(dict(ROOM))
+    for collection_name, keys, options in server.INDEXES:
+        if collection_name == "messages" and keys[-1][0] == "client_message_id":
+            await db.messages.create_index(keys, **options)
+    return ROOM
+
+
+async def test_cancelled_sender_does_not_strand_batch(writer, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 1000)
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MAX", 3)
+
+    async def slow_commit(entries):
+        await asyncio.sleep(0.05)
+        return [True] * len(entries)
+    writer._commit = slow_commit
+
+    first = asyncio.create_task(writer.write(ROOM, {"n": 1}))
+    second = asyncio.create_task(writer.write(ROOM, {"n": 2}))
+    await asyncio.sleep(0)
+    # The third send fills the batch; its client then goes away mid-commit
+    third = asyncio.create_task(writer.write(ROOM, {"n": 3}))
+    await asyncio.sleep(0.01)
+    third.cancel()
+
+    assert await asyncio.wait_for(asyncio.gather(first, second), 1) == [True, True]
+
+
+async def test_interrupted_flush_answers_every_sender(writer, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 1000)
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MAX", 2)
+
+    async def stuck_commit(entries):
+        await asyncio.Event().wait()
+    writer._commit = stuck_commit
+
+    sends = [asyncio.create_task(writer.write(ROOM, {"n": i})) for i in range(2)]
+    await asyncio.sleep(0.01)
+    for task in list(writer._flushes):
+        task.cancel()
+
+    results = await asyncio.wait_for(asyncio.gather(*sends, return_exceptions=True), 1)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+async def test_concurrent_sends_are_group_committed(db, room, writer, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 20)
+    batches = []
+    commit = writer._commit
+
+    async def counting_commit(entries):
+        batches.append(len(entries))
+        return await commit(entries)
+    writer._commit = counting_commit
+
+    messages = await asyncio.gather(*[server._post_message(room, WISHER, f"message {i}") for i in range(5)])
+
+    assert batches == [5]
+    assert await db.messages.count_documents({"room_id": "room_1"}) == 5
+    stored_room = await db.chat_rooms.find_one({"room_id": "room_1"})
+    assert stored_room["unread"] == {"agent_1": 5}
+    assert stored_room["last_message"]["message_id"] == max(messages, key=lambda m: m.created_at).message_id
+
+
+@pytest.mark.parametrize("batch_ms", [0, 20])
+async def test_retried_send_returns_original_message(db, room, writer, monkeypatch, batch_ms):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", batch_ms)
+    subscription = server.event_hub.subscribe("room:room_1")
+    try:
+        first = await server._post_message(room, WISHER, "hello", "client-1")
+        retried = await server._post_message(room, WISHER, "hello", "client-1")
+
+        assert retried.message_id == first.message_id
+        assert await db.messages.count_documents({"room_id": "room_1"}) == 1
+        stored_room = await db.chat_rooms.find_one({"room_id": "room_1"})
+        assert stored_room["unread"] == {"agent_1": 1}
+        # Only the first attempt is fanned out
+        assert (await subscription.get(0.05))["data"]["message_id"] == first.message_id
+        assert await subscription.get(0.05) is None
+    finally:
+        subscription.close()
+
+
+async def test_duplicates_within_one_batch_store_one_message(db, room, writer, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 20)
+
+    messages = await asyncio.gather(*[server._post_message(room, WISHER, "hello", "client-1") for _ in range(3)])
+
+    assert len({message.message_id for message in messages}) == 1
+    assert await db.messages.count_documents({"room_id": "room_1"}) == 1
+
+
+async def test_sends_without_client_id_are_never_deduplicated(db, room, writer, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 0)
+
+    await server._post_message(room, WISHER, "hello")
+    await server._post_message(room, WISHER, "hello")
+
+    assert await db.messages.count_documents({"room_id": "room_1"}) == 2
@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+from server import MessageWriter, User
+
+pytestmark = pytest.mark.anyio
+
+WISHER = User(user_id="user_1", email="wisher@example.com", name="Wisher")
+AGENT = User(user_id="agent_1", email="agent@example.com", name="Agent")
+
+
+@pytest.fixture
+async def rooms(db, monkeypatch):
+    monkeypatch.setattr(server, "message_writer", MessageWriter())
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 0)
+    created_at = datetime.now(timezone.utc) - timedelta(days=1)
+    await db.wishes.insert_many([{"wish_id": "wish_1", "title": "Groceries"}, {"wish_id": "wish_2", "title": "Medicine"}])
+    await db.chat_rooms.insert_many([
+        {"room_id": "room_1", "wish_id": "wish_1", "wisher_id": "user_1", "agent_id": "agent_1", "created_at": created_at},
+        {"room_id": "room_2", "wish_id": "wish_2", "wisher_id": "user_1", "agent_id": "agent_2", "created_at": created_at + timedelta(hours=1)},
+    ])
+    return {room["room_id"]: room async for room in db.chat_rooms.find({}, {"_id": 0})}
+
+
+async def test_rooms_list_by_recent_activity_with_unread_counts(rooms):
+    await server._post_message(rooms["room_1"], WISHER, "hi")
+    await server._post_message(rooms["room_1"], AGENT, "on my way")
+    await server._post_message(rooms["room_1"], AGENT, "here")
+
+    listed = await server.get_chat_rooms(WISHER)
+
+    assert [room["room_id"] for room in listed] == ["room_1", "room_2"]
+    assert listed[0]["last_message"]["content"] == "here"
+    assert listed[0]["unread_count"] == 2
+    assert listed[0]["wish"]["title"] == "Groceries"
+    assert listed[1]["last_message"] is None
+    assert listed[1]["unread_count"] == 0
+    assert all("unread" not in room for room in listed)
+
+
+async def test_opening_room_marks_it_read(db, rooms):
+    await server._post_message(rooms["room_1"], AGENT, "on my way")
+
+    messages = await server.get_messages("room_1", current_user=WISHER)
+
+    assert [message.content for message in messages] == ["on my way"]
+    room = await db.chat_rooms.find_one({"room_id": "room_1"})
+    # The agent's own counter is untouched
+    assert room["unread"] == {"user_1": 0}
+
+
+async def test_late_message_does_not_replace_last_message(db, rooms):
+    await server._post_message(rooms["room_1"], WISHER, "latest")
+    late = {"message_id": "msg_late", "content": "$last_message", "created_at": datetime.now(timezone.utc) - timedelta(hours=1)}
+
+    await db.chat_rooms.update_one({"room_id": "room_1"}, server.chat_room_message_update(late, {"agent_1": 1}))
+
+    room = await db.chat_rooms.find_one({"room_id": "room_1"})
+    assert room["last_message"]["content"] == "latest"
+    assert room["unread"] == {"agent_1": 2}
+
+
+async def test_message_content_is_stored_literally(db, rooms):
+    await server._post_message(rooms["room_1"], WISHER, "$last_message_at")
+
+    room = await db.chat_rooms.find_one({"room_id": "room_1"})
+    assert room["last_message"]["content"] == "$last_message_at"
+
+
+async def test_message_pages_walk_history_in_order(rooms):
+    sent = []
+    for i in range(7):
+        sent.append(await server._post_message(rooms["room_1"], WISHER, f"message {i}"))
+        # Distinct stored timestamps, so send order is page order
+        await asyncio.sleep(0.002)
+    ids = [message.message_id for message in sent]
+
+    latest = await server.get_messages("room_1", limit=3, current_user=WISHER)
+    older = await server.get_messages("room_1", before=latest[0].message_id, limit=3, current_user=WISHER)
+    newer = await server.get_messages("room_1", after=older[-1].message_id, limit=2, current_user=WISHER)
+    since = await server.get_messages("room_1", since=ids[1], current_user=WISHER)
+
+    assert [m.message_id for m in latest] == ids[4:]
+    assert [m.message_id for m in older] == ids[1:4]
+    assert [m.message_id for m in newer] == ids[4:6]
+    assert [m.message_id for m in since] == ids[2:]
@@ -0,0 +1,61 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def keys(db):
+    for collection_name, keys, options in server.INDEXES:
+        if collection_name == "idempotency_keys":
+            await db.idempotency_keys.create_index(keys, **options)
+    return db.idempotency_keys
+
+
+async def test_concurrent_retry_is_rejected_while_claim_is_live(keys):
+    assert await server.claim_idempotency_key("user_1", "key_1") is None
+
+    with pytest.raises(HTTPException) as error:
+        await server.claim_idempotency_key("user_1", "key_1")
+
+    assert error.value.status_code == 409
+    # Keys are per user
+    assert await server.claim_idempotency_key("user_2", "key_1") is None
+
+
+async def test_expired_claim_is_taken_over_once(keys, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_LEASE_SECONDS", 0)
+    assert await server.claim_idempotency_key("user_1", "key_1") is None
+    monkeypatch.setattr(server, "IDEMPOTENCY_LEASE_SECONDS", 60)
+
+    # The first holder died; this retry inherits the key and renews the lease
+    assert await server.claim_idempotency_key("user_1", "key_1") is None
+    with pytest.raises(HTTPException) as error:
+        await server.claim_idempotency_key("user_1", "key_1")
+
+    assert error.value.status_code == 409
+    assert await keys.count_documents({}) == 1
+
+
+async def test_completed_request_replays_its_response(keys, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_LEASE_SECONDS", 0)
+    await server.claim_idempotency_key("user_1", "key_1")
+    await server.complete_idempotency_key("user_1", "key_1", {"order_id": "order_1"})
+
+    # A finished request is never taken over, however old its lease
+    assert await server.claim_idempotency_key("user_1", "key_1") == {"order_id": "order_1"}
+    stored = await keys.find_one({"user_id": "user_1", "key": "key_1"})
+    assert "locked_until" not in stored
+
+
+async def test_release_lets_retry_run_but_keeps_completed_keys(keys):
+    await server.claim_idempotency_key("user_1", "failed")
+    await server.release_idempotency_key("user_1", "failed")
+    assert await server.claim_idempotency_key("user_1", "failed") is None
+
+    await server.claim_idempotency_key("user_1", "done")
+    await server.complete_idempotency_key("user_1", "done", {"order_id": "order_1"})
+    await server.release_idempotency_key("user_1", "done")
+    assert await server.claim_idempotency_key("user_1", "done") == {"order_id": "order_1"}
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+KEYS = [("user_id", 1), ("vendor_id", 1)]
+
+
+class IndexedCollection:
+    """Collection stub whose index calls follow a script: each entry is returned, or raised if an exception"""
+
+    def __init__(self, creates=(), drops=()):
+        self.creates = list(creates)
+        self.drops = list(drops)
+        self.calls = []
+
+    async def index_information(self):
+        return {"user_id_1_vendor_id_1": {"key": KEYS, "v": 2}}
+
+    async def create_index(self, keys, **options):
+        self.calls.append(("create", options))
+        return self.next(self.creates)
+
+    async def drop_index(self, keys):
+        self.calls.append(("drop", None))
+        return self.next(self.drops)
+
+    @staticmethod
+    def next(script):
+        outcome = script.pop(0) if script else None
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def carts(monkeypatch):
+    async def no_duplicates():
+        pass
+    monkeypatch.setattr(server, "merge_duplicate_carts", no_duplicates)
+    monkeypatch.setattr(server, "INDEXES", [("carts", KEYS, {"unique": True})])
+
+    def use(collection):
+        monkeypatch.setattr(server, "db", {"carts": collection})
+        return collection
+    return use
+
+
+async def test_changed_index_is_rebuilt(carts):
+    collection = carts(IndexedCollection(creates=[OperationFailure("conflict", 86)]))
+
+    await server.ensure_indexes()
+
+    assert collection.calls == [("create", {"unique": True}), ("drop", None), ("create", {"unique": True})]
+
+
+async def test_index_dropped_by_another_worker_is_still_created(carts):
+    collection = carts(IndexedCollection(
+        creates=[OperationFailure("conflict", 86)],
+        drops=[OperationFailure("index not found", server.INDEX_NOT_FOUND_CODE)],
+    ))
+
+    await server.ensure_indexes()
+
+    assert collection.calls[-1] == ("create", {"unique": True})
+
+
+async def test_other_drop_failure_skips_the_index(carts):
+    collection = carts(IndexedCollection(
+        creates=[OperationFailure("conflict", 86)],
+        drops=[OperationFailure("not authorized", 13)],
+    ))
+
+    await server.ensure_indexes()
+
+    assert collection.calls == [("create", {"unique": True}), ("drop", None)]
+
+
+async def test_failed_rebuild_restores_previous_index(carts):
+    collection = carts(IndexedCollection(creates=[OperationFailure("conflict", 86), OperationFailure("duplicate key", 11000)]))
+
+    with pytest.raises(OperationFailure):
+        await server.ensure_indexes()
+
+    assert collection.calls[-1] == ("create", {"name": "user_id_1_vendor_id_1"})
+
+
+def plan(stage, rejected_stage="COLLSCAN"):
+    return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": stage}}, "rejectedPlans": [{"stage": rejected_stage}]}}
+
+
+@pytest.mark.parametrize("explain, stages", [
+    (plan("IXSCAN"), ["FETCH", "IXSCAN"]),
+    # Aggregations nest the query planner output under their first stage
+    ({"stages": [{"$geoNearCursor": plan("GEO_NEAR_2DSPHERE")}, {"$project": {}}]}, ["FETCH", "GEO_NEAR_2DSPHERE"]),
+])
+def test_winning_plan_stages_skip_rejected_plans(explain, stages):
+    assert server.winning_plan_stages(explain) == stages
+
+
+async def test_query_plan_check_explains_the_geo_near_aggregation(monkeypatch):
+    async def no_indexes():
+        pass
+    monkeypatch.setattr(server, "ensure_indexes", no_indexes)
+    monkeypatch.setattr(server, "QUERY_SHAPES", [])
+    commands = []
+
+    async def command(name, value, **kwargs):
+        commands.append(value)
+        stage = "COLLSCAN" if value["pipeline"][0]["$geoNear"]["query"] else "GEO_NEAR_2DSPHERE"
+        return {"stages": [{"$geoNearCursor": plan(stage)}]}
+    monkeypatch.setattr(server, "db", SimpleNamespace(command=command))
+
+    assert await server.check_query_plans() is False
+    assert [value["aggregate"] for value in commands] == ["hub_vendors", "hub_vendors"]
+    assert all("$geoNear" in value["pipeline"][0] for value in commands)
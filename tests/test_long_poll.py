@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+from server import MessageWriter, User
+
+WISHER = User(user_id="user_1", email="wisher@example.com", name="Wisher")
+AGENT = User(user_id="agent_1", email="agent@example.com", name="Agent")
+
+
+@pytest.fixture
+async def room(db, monkeypatch):
+    monkeypatch.setattr(server, "message_writer", MessageWriter())
+    monkeypatch.setattr(server, "MESSAGE_BATCH_MS", 0)
+    monkeypatch.setattr(server, "MESSAGE_PAGE_SIZE", 3)
+    room = {"room_id": "room_1", "wish_id": "wish_1", "wisher_id": "user_1", "agent_id": "agent_1"}
+    await db.chat_rooms.insert_one(dict(room))
+    return room
+
+
+async def send(room, count):
+    sent = []
+    for i in range(count):
+        sent.append((await server._post_message(room, AGENT, f"message {i}")).message_id)
+        await asyncio.sleep(0.002)
+    return sent
+
+
+@pytest.mark.anyio
+async def test_without_cursor_returns_latest_page_at_once(room):
+    sent = await send(room, 5)
+
+    result = await asyncio.wait_for(server.wait_for_events(room_id="room_1", timeout=10, current_user=WISHER), 1)
+
+    assert [message.message_id for message in result["messages"]] == sent[2:]
+    assert result["cursor"] == sent[-1]
+
+
+@pytest.mark.anyio
+async def test_without_cursor_in_empty_room_waits_for_first_message(room):
+    waiting = asyncio.create_task(server.wait_for_events(room_id="room_1", timeout=10, current_user=WISHER))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    sent = await send(room, 1)
+
+    result = await asyncio.wait_for(waiting, 1)
+    assert [message.message_id for message in result["messages"]] == sent
+    assert result["cursor"] == sent[0]
+
+
+@pytest.mark.anyio
+async def test_cursor_returns_only_newer_messages(room):
+    sent = await send(room, 2)
+    waiting = asyncio.create_task(server.wait_for_events(room_id="room_1", cursor=sent[-1], timeout=10, current_user=WISHER))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    newer = await send(room, 1)
+
+    result = await asyncio.wait_for(waiting, 1)
+    assert [message.message_id for message in result["messages"]] == newer
+
+
+@pytest.mark.anyio
+async def test_timeout_returns_same_cursor(room):
+    sent = await send(room, 1)
+
+    result = await server.wait_for_events(room_id="room_1", cursor=sent[0], timeout=0.01, current_user=WISHER)
+
+    assert result == {"messages": [], "cursor": sent[0]}
+
+
+@pytest.mark.anyio
+async def test_order_status_change_wakes_waiter(db):
+    await db.shop_orders.insert_one({"order_id": "order_1", "user_id": "user_1", "status": "confirmed", "status_history": [{"status": "confirmed"}], "items": []})
+    waiting = asyncio.create_task(server.wait_for_events(order_id="order_1", cursor="1", timeout=10, current_user=WISHER))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    await server.update_order_status("order_1", "preparing")
+
+    result = await asyncio.wait_for(waiting, 1)
+    assert result["status"] == "preparing"
+    assert [entry["status"] for entry in result["status_history"]] == ["preparing"]
+    assert result["cursor"] == "2"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("timeout", [float("nan"), float("inf"), -1, server.LONG_POLL_MAX_SECONDS + 1])
+async def test_out_of_range_timeout_is_rejected(room, timeout):
+    with pytest.raises(HTTPException) as error:
+        await server.wait_for_events(room_id="room_1", timeout=timeout, current_user=WISHER)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("timeout", ["nan", "inf", "-1", str(server.LONG_POLL_MAX_SECONDS + 1)])
+def test_out_of_range_timeout_is_rejected_over_http(timeout, monkeypatch):
+    monkeypatch.setitem(server.app.dependency_overrides, server.require_auth, lambda: WISHER)
+
+    response = TestClient(server.app).get("/api/events/wait", params={"room_id": "room_1", "timeout": timeout})
+
+    assert response.status_code == 422
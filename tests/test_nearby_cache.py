@@ -0,0 +1,107 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import server
+from server import NEARBY_RADIUS_BUCKETS_KM, NearbyVendorCache, haversine_km
+
+CENTER = (12.9716, 77.5946)
+
+
+class HubVendorsStub:
+    """Answers $geoNear with every stored vendor inside maxDistance and counts the round trips"""
+
+    def __init__(self, vendors):
+        self.vendors = vendors
+        self.aggregations = 0
+
+    def aggregate(self, pipeline):
+        self.aggregations += 1
+        geo_near = pipeline[0]["$geoNear"]
+        lng, lat = geo_near["near"]["coordinates"]
+        matches = [
+            dict(vendor) for vendor in self.vendors
+            if haversine_km(lat, lng, vendor["location"]["lat"], vendor["location"]["lng"]) * 1000 <= geo_near["maxDistance"]
+        ]
+
+        async def to_list(length):
+            return matches
+        return SimpleNamespace(to_list=to_list)
+
+
+@pytest.fixture
+def hub_vendors(monkeypatch):
+    stub = HubVendorsStub([
+        {"vendor_id": "v1", "location": {"lat": CENTER[0] + 0.005, "lng": CENTER[1]}},
+        {"vendor_id": "v2", "location": {"lat": CENTER[0] + 0.03, "lng": CENTER[1]}},
+    ])
+    monkeypatch.setattr(server, "db", SimpleNamespace(hub_vendors=stub))
+    monkeypatch.setattr(server, "nearby_vendor_cache", NearbyVendorCache(maxsize=10, ttl_seconds=60, tile_degrees=0.01))
+    return stub
+
+
+def test_nearby_cache_cover_contains_every_query_circle():
+    cache = NearbyVendorCache(maxsize=10, ttl_seconds=60, tile_degrees=0.01)
+    rng = random.Random(5)
+    for _ in range(2000):
+        lat = rng.uniform(-60, 60)
+        lng = rng.uniform(-180, 180)
+        radius_km = rng.uniform(0.1, NEARBY_RADIUS_BUCKETS_KM[-1])
+        key = cache.key(lat, lng, radius_km, None)
+        cover_lat, cover_lng, cover_radius_km = cache.cover(key)
+        # Any vendor within radius_km of the caller must be inside the cached cover circle
+        assert haversine_km(lat, lng, cover_lat, cover_lng) + radius_km <= cover_radius_km + 1e-9
+
+
+def test_nearby_cache_lru_and_ttl(clock):
+    cache = NearbyVendorCache(maxsize=2, ttl_seconds=60, tile_degrees=0.01)
+    cache.set("a", [{"vendor_id": "v1"}])
+    cache.set("b", [{"vendor_id": "v2"}])
+    cache.get("a")
+    cache.set("c", [{"vendor_id": "v3"}])
+    assert cache.get("b") is None
+    assert cache.get("a") == [{"vendor_id": "v1"}]
+
+    clock.now += 61
+    assert cache.get("a") is None
+
+
+def test_nearby_cache_invalidates_entries_holding_or_reaching_vendor():
+    cache = NearbyVendorCache(maxsize=10, ttl_seconds=60, tile_degrees=0.01)
+    here = cache.key(*CENTER, 1.0, None)
+    far = cache.key(CENTER[0] + 1, CENTER[1], 1.0, None)
+    cache.set(here, [])
+    cache.set(far, [{"vendor_id": "v1", "location": {"lat": CENTER[0] + 1, "lng": CENTER[1]}}])
+
+    # v1 moves from the far tile to this one: both entries are now wrong
+    cache.invalidate_vendor({"vendor_id": "v1", "location": {"lat": CENTER[0], "lng": CENTER[1]}})
+
+    assert cache.get(here) is None
+    assert cache.get(far) is None
+
+
+@pytest.mark.anyio
+async def test_neighbours_share_one_candidate_query(hub_vendors):
+    lat, lng = CENTER
+    first = await server.nearby_vendors_from_cache(lat, lng, 1.0, None)
+    # A caller a few metres away in the same tile gets exact distances from its own position
+    second = await server.nearby_vendors_from_cache(lat + 0.001, lng, 1.0, None)
+
+    assert hub_vendors.aggregations == 1
+    assert [vendor["vendor_id"] for vendor in first] == ["v1"]
+    assert first[0]["distance_km"] != second[0]["distance_km"]
+
+
+@pytest.mark.anyio
+async def test_vendor_write_refreshes_cached_tile(hub_vendors):
+    lat, lng = CENTER
+    assert [vendor["vendor_id"] for vendor in await server.nearby_vendors_from_cache(lat, lng, 1.0, None)] == ["v1"]
+
+    moved = {"vendor_id": "v2", "location": {"lat": lat, "lng": lng}}
+    hub_vendors.vendors[1] = moved
+    server.on_vendor_changed(moved)
+
+    result = await server.nearby_vendors_from_cache(lat, lng, 1.0, None)
+    assert hub_vendors.aggregations == 2
+    assert [vendor["vendor_id"] for vendor in result] == ["v2", "v1"]
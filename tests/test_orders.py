@@ -0,0 +1,112 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import ORDER_STATUS_TRANSITIONS, previous_order_statuses
+
+# Forward order of the delivery flow; cancelled is reachable only before pickup
+STATUS_SEQUENCE = ["confirmed", "preparing", "ready", "picked_up", "on_the_way", "nearby", "delivered"]
+
+
+def test_transitions_only_name_known_statuses():
+    for next_statuses in ORDER_STATUS_TRANSITIONS.values():
+        assert set(next_statuses) <= set(ORDER_STATUS_TRANSITIONS)
+
+
+def test_final_statuses_have_no_transitions():
+    assert ORDER_STATUS_TRANSITIONS["delivered"] == []
+    assert ORDER_STATUS_TRANSITIONS["cancelled"] == []
+
+
+def test_transitions_never_go_backwards():
+    for status, next_statuses in ORDER_STATUS_TRANSITIONS.items():
+        for next_status in next_statuses:
+            if next_status == "cancelled":
+                continue
+            assert STATUS_SEQUENCE.index(next_status) > STATUS_SEQUENCE.index(status)
+
+
+def test_cancel_only_before_pickup():
+    assert set(previous_order_statuses("cancelled")) == {"confirmed", "preparing", "ready"}
+
+
+@pytest.mark.parametrize("status, expected", [
+    ("confirmed", []),
+    ("preparing", ["confirmed"]),
+    ("ready", ["preparing"]),
+    ("picked_up", ["ready"]),
+    ("on_the_way", ["ready", "picked_up"]),
+    ("nearby", ["on_the_way"]),
+    ("delivered", ["on_the_way", "nearby"]),
+])
+def test_previous_order_statuses(status, expected):
+    assert sorted(previous_order_statuses(status)) == sorted(expected)
+
+
+@pytest.fixture
+async def order(db):
+    await db.products.insert_one({"product_id": "p1", "stock": 3})
+    await db.shop_orders.insert_one({
+        "order_id": "order_1",
+        "status": "confirmed",
+        "status_history": [],
+        "items": [{"product_id": "p1", "quantity": 2}],
+    })
+
+
+async def stored_order(db):
+    return await db.shop_orders.find_one({"order_id": "order_1"})
+
+
+@pytest.mark.anyio
+async def test_status_and_history_move_together(db, order):
+    await server.update_order_status("order_1", "preparing", estimated_delivery="12:30")
+
+    stored = await stored_order(db)
+    assert stored["status"] == "preparing"
+    assert stored["estimated_delivery"] == "12:30"
+    assert [entry["status"] for entry in stored["status_history"]] == ["preparing"]
+
+
+@pytest.mark.anyio
+async def test_retried_transition_is_not_recorded_twice(db, order):
+    await server.update_order_status("order_1", "preparing")
+    await server.update_order_status("order_1", "preparing")
+
+    assert [entry["status"] for entry in (await stored_order(db))["status_history"]] == ["preparing"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path, status", [
+    (["preparing", "ready", "picked_up"], "cancelled"),
+    (["preparing", "ready"], "preparing"),
+    ([], "delivered"),
+])
+async def test_disallowed_transition_is_a_conflict(db, order, path, status):
+    for step in path:
+        await server.update_order_status("order_1", step)
+
+    with pytest.raises(HTTPException) as error:
+        await server.update_order_status("order_1", status)
+
+    assert error.value.status_code == 409
+    assert len((await stored_order(db))["status_history"]) == len(path)
+
+
+@pytest.mark.anyio
+async def test_unknown_order_and_status(db, order):
+    with pytest.raises(HTTPException) as error:
+        await server.update_order_status("missing", "preparing")
+    assert error.value.status_code == 404
+
+    with pytest.raises(HTTPException) as error:
+        await server.update_order_status("order_1", "lost")
+    assert error.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_cancel_restocks_once(db, order):
+    await server.update_order_status("order_1", "cancelled")
+    await server.update_order_status("order_1", "cancelled")
+
+    assert (await db.products.find_one({"product_id": "p1"}))["stock"] == 5
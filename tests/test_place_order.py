@@ -0,0 +1,109 @@
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import AutoReconnect
+
+import server
+from server import OrderCreate, User
+
+pytestmark = pytest.mark.anyio
+
+USER = User(user_id="user_1", email="user@example.com", name="User")
+CART_ITEMS = [{"product_id": "p1", "quantity": 2}, {"product_id": "p2", "quantity": 1}]
+
+
+class FailingInserts:
+    """A collection whose inserts fail as if the connection dropped mid-order"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def insert_one(self, document, session=None):
+        raise AutoReconnect("connection reset")
+
+
+@pytest.fixture
+async def shop(db):
+    await db.hub_vendors.insert_one({"vendor_id": "vendor_1", "name": "Vendor", "location": {"lat": 12.97, "lng": 77.59}})
+    await db.products.insert_many([
+        {"product_id": "p1", "vendor_id": "vendor_1", "name": "Rice", "price": 50, "stock": 5},
+        {"product_id": "p2", "vendor_id": "vendor_1", "name": "Dal", "price": 80, "stock": 1},
+    ])
+    await db.carts.insert_one({"user_id": "user_1", "vendor_id": "vendor_1", "items": list(CART_ITEMS), "item_count": 3})
+    return db
+
+
+async def stock(db):
+    return {p["product_id"]: p["stock"] async for p in db.products.find({})}
+
+
+def order_request(delivery_type="agent_delivery"):
+    return OrderCreate(vendor_id="vendor_1", delivery_address={"address": "Home"}, delivery_type=delivery_type)
+
+
+async def test_order_takes_stock_and_clears_cart(shop):
+    response = await server.place_order(order_request(), USER)
+
+    assert await stock(shop) == {"p1": 3, "p2": 0}
+    assert await shop.carts.count_documents({}) == 0
+    assert await shop.shop_orders.count_documents({"order_id": response["order"]["order_id"]}) == 1
+    assert await shop.wishes.count_documents({"linked_order_id": response["order"]["order_id"]}) == 1
+
+
+async def test_short_line_puts_back_the_lines_already_taken(shop):
+    await shop.products.update_one({"product_id": "p2"}, {"$set": {"stock": 0}})
+
+    with pytest.raises(HTTPException) as error:
+        await server.place_order(order_request(), USER)
+
+    assert error.value.status_code == 409
+    assert "Dal" in error.value.detail
+    assert await stock(shop) == {"p1": 5, "p2": 0}
+    assert await shop.carts.count_documents({}) == 1
+
+
+@pytest.mark.parametrize("failing_collection", ["shop_orders", "wishes"])
+async def test_failed_write_is_rolled_back_without_transaction(shop, monkeypatch, failing_collection):
+    monkeypatch.setattr(shop, failing_collection, FailingInserts(getattr(shop, failing_collection)))
+
+    with pytest.raises(AutoReconnect):
+        await server.place_order(order_request(), USER)
+
+    assert await stock(shop) == {"p1": 5, "p2": 1}
+    assert await shop.shop_orders.count_documents({}) == 0
+    cart = await shop.carts.find_one({"user_id": "user_1"})
+    assert cart["items"] == CART_ITEMS
+
+
+async def test_cart_changed_while_placing_is_a_conflict(shop, monkeypatch):
+    load_products = server.load_products
+
+    async def load_products_then_edit_cart(product_ids):
+        products = await load_products(product_ids)
+        await shop.carts.update_one({"user_id": "user_1"}, {"$set": {"items": CART_ITEMS[:1]}})
+        return products
+    monkeypatch.setattr(server, "load_products", load_products_then_edit_cart)
+
+    with pytest.raises(HTTPException) as error:
+        await server.place_order(order_request(), USER)
+
+    assert error.value.status_code == 409
+    assert await stock(shop) == {"p1": 5, "p2": 1}
+    assert await shop.shop_orders.count_documents({}) == 0
+
+
+async def test_failed_order_releases_idempotency_key_for_retry(shop, monkeypatch):
+    await shop.idempotency_keys.create_index([("user_id", 1), ("key", 1)], unique=True)
+    wishes = shop.wishes
+    monkeypatch.setattr(shop, "wishes", FailingInserts(wishes))
+    with pytest.raises(AutoReconnect):
+        await server.create_order(order_request(), USER, "key_1")
+
+    monkeypatch.setattr(shop, "wishes", wishes)
+    response = await server.create_order(order_request(), USER, "key_1")
+
+    assert await server.create_order(order_request(), USER, "key_1") == response
+    assert await shop.shop_orders.count_documents({}) == 1
+    assert await stock(shop) == {"p1": 3, "p2": 0}
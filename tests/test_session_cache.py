@@ -0,0 +1,54 @@
+from datetime import datetime, timezone, timedelta
+
+from server import SessionCache
+
+
+def later(hours=1):
+    return datetime.now(timezone.utc) + timedelta(hours=hours)
+
+
+def test_session_cache_hit_and_ttl(clock):
+    cache = SessionCache(maxsize=10, ttl_seconds=60)
+    cache.set("t1", {"user_id": "u1"}, later())
+    assert cache.get("t1") == {"user_id": "u1"}
+
+    clock.now += 61
+    assert cache.get("t1") is None
+
+
+def test_session_cache_drops_expired_sessions(clock):
+    cache = SessionCache(maxsize=10, ttl_seconds=60)
+    cache.set("t1", {"user_id": "u1"}, datetime.now(timezone.utc) - timedelta(seconds=1))
+    assert cache.get("t1") is None
+
+
+def test_session_cache_evicts_least_recently_used(clock):
+    cache = SessionCache(maxsize=2, ttl_seconds=60)
+    cache.set("t1", {"user_id": "u1"}, later())
+    cache.set("t2", {"user_id": "u2"}, later())
+    cache.get("t1")
+    cache.set("t3", {"user_id": "u3"}, later())
+
+    assert cache.get("t2") is None
+    assert cache.get("t1") == {"user_id": "u1"}
+    assert cache.get("t3") == {"user_id": "u3"}
+
+
+def test_session_cache_invalidate_user(clock):
+    cache = SessionCache(maxsize=10, ttl_seconds=60)
+    cache.set("t1", {"user_id": "u1"}, later())
+    cache.set("t2", {"user_id": "u1"}, later())
+    cache.set("t3", {"user_id": "u2"}, later())
+
+    cache.invalidate_user("u1")
+
+    assert cache.get("t1") is None
+    assert cache.get("t2") is None
+    assert cache.get("t3") == {"user_id": "u2"}
+    assert "u1" not in cache._tokens_by_user
+
+
+def test_session_cache_disabled_when_size_zero(clock):
+    cache = SessionCache(maxsize=0, ttl_seconds=60)
+    cache.set("t1", {"user_id": "u1"}, later())
+    assert cache.get("t1") is None
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+import server
+from server import VendorCoverageIndex, VendorGeoIndex, haversine_km
+
+CENTER = (12.9716, 77.5946)
+
+
+def make_vendors(count, seed=1, spread=0.3):
+    rng = random.Random(seed)
+    return [
+        {
+            "vendor_id": f"v{i}",
+            "name": f"Vendor {i}",
+            "category": rng.choice(["grocery", "pharmacy", "restaurant"]),
+            "location": {"lat": CENTER[0] + rng.uniform(-spread, spread), "lng": CENTER[1] + rng.uniform(-spread, spread)},
+            "delivery_radius_km": rng.uniform(1, 15),
+        }
+        for i in range(count)
+    ]
+
+
+def query_points(count, seed=2):
+    rng = random.Random(seed)
+    return [(CENTER[0] + rng.uniform(-0.3, 0.3), CENTER[1] + rng.uniform(-0.3, 0.3)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("category", [None, "pharmacy"])
+def test_coverage_index_matches_brute_force(category):
+    vendors = make_vendors(1500, seed=3)
+    index = VendorCoverageIndex(cell_degrees=0.05)
+    for vendor in vendors:
+        index.upsert(vendor)
+
+    for lat, lng in query_points(50, seed=4):
+        expected = sorted(
+            (haversine_km(lat, lng, v["location"]["lat"], v["location"]["lng"]), v["vendor_id"])
+            for v in vendors
+            if (not category or v["category"] == category)
+            and haversine_km(lat, lng, v["location"]["lat"], v["location"]["lng"]) <= v["delivery_radius_km"]
+        )
+        assert index.covering(lat, lng, category) == expected
+
+
+def test_coverage_index_remove():
+    index = VendorCoverageIndex(cell_degrees=0.05)
+    index.upsert({"vendor_id": "v1", "location": {"lat": CENTER[0], "lng": CENTER[1]}, "delivery_radius_km": 5})
+    assert [vendor_id for _, vendor_id in index.covering(*CENTER, None)] == ["v1"]
+
+    index.remove("v1")
+    assert index.covering(*CENTER, None) == []
+    assert index._cells == {}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("geo_index_loaded", [False, True])
+async def test_deliverable_mode_lists_only_vendors_that_reach_caller(db, monkeypatch, geo_index_loaded):
+    vendors = make_vendors(300, seed=6)
+    await db.hub_vendors.insert_many([dict(vendor) for vendor in vendors])
+    monkeypatch.setattr(server, "vendor_coverage_index", VendorCoverageIndex(cell_degrees=0.05))
+    geo_index = VendorGeoIndex(cell_degrees=0.05)
+    if geo_index_loaded:
+        await geo_index.load()
+    monkeypatch.setattr(server, "vendor_geo_index", geo_index)
+
+    lat, lng = CENTER
+    result = await server.get_hub_vendors(lat=lat, lng=lng, deliverable=True, limit=100)
+
+    expected = sorted(
+        (haversine_km(lat, lng, v["location"]["lat"], v["location"]["lng"]), v["vendor_id"])
+        for v in vendors
+        if haversine_km(lat, lng, v["location"]["lat"], v["location"]["lng"]) <= v["delivery_radius_km"]
+    )
+    assert [vendor["vendor_id"] for vendor in result] == [vendor_id for _, vendor_id in expected][:100]
+    assert all("_id" not in vendor for vendor in result)
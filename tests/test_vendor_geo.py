@@ -0,0 +1,132 @@
+import random
+
+import pytest
+
+import server
+from server import (
+    VendorGeoIndex,
+    haversine_km,
+)
+
+CENTER = (12.9716, 77.5946)
+
+
+def make_vendors(count, seed=1, spread=0.3):
+    rng = random.Random(seed)
+    return [
+        {
+            "vendor_id": f"v{i}",
+            "name": f"Vendor {i}",
+            "category": rng.choice(["grocery", "pharmacy", "restaurant"]),
+            "location": {"lat": CENTER[0] + rng.uniform(-spread, spread), "lng": CENTER[1] + rng.uniform(-spread, spread)},
+            "delivery_radius_km": rng.uniform(1, 15),
+        }
+        for i in range(count)
+    ]
+
+
+def brute_force_nearby(vendors, lat, lng, radius_km, category):
+    matches = []
+    for vendor in vendors:
+        if category and vendor["category"] != category:
+            continue
+        distance = haversine_km(lat, lng, vendor["location"]["lat"], vendor["location"]["lng"])
+        if distance <= radius_km:
+            matches.append((distance, vendor["vendor_id"]))
+    return sorted(matches)
+
+
+def query_points(count, seed=2):
+    rng = random.Random(seed)
+    return [(CENTER[0] + rng.uniform(-0.3, 0.3), CENTER[1] + rng.uniform(-0.3, 0.3)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("radius_km", [0.5, 2.0, 5.0, 12.0])
+@pytest.mark.parametrize("category", [None, "grocery"])
+def test_geo_index_matches_brute_force(radius_km, category):
+    vendors = make_vendors(2000)
+    index = VendorGeoIndex(cell_degrees=0.05)
+    for vendor in vendors:
+        index.upsert(vendor)
+
+    for lat, lng in query_points(25):
+        expected = brute_force_nearby(vendors, lat, lng, radius_km, category)
+        result = index.nearby(lat, lng, radius_km, category, k=len(vendors))
+        assert [doc["vendor_id"] for _, doc in result] == [vendor_id for _, vendor_id in expected]
+        for (distance, _), (expected_distance, _) in zip(result, expected):
+            assert distance == pytest.approx(expected_distance, abs=1e-6)
+
+
+def test_geo_index_limits_to_k_nearest():
+    vendors = make_vendors(500)
+    index = VendorGeoIndex(cell_degrees=0.05)
+    for vendor in vendors:
+        index.upsert(vendor)
+
+    lat, lng = CENTER
+    expected = brute_force_nearby(vendors, lat, lng, 20.0, None)[:10]
+    result = index.nearby(lat, lng, 20.0, None, k=10)
+    assert [doc["vendor_id"] for _, doc in result] == [vendor_id for _, vendor_id in expected]
+
+
+def test_geo_index_move_and_remove():
+    index = VendorGeoIndex(cell_degrees=0.05)
+    vendor = {"vendor_id": "v1", "category": "grocery", "location": {"lat": CENTER[0], "lng": CENTER[1]}}
+    index.upsert(vendor)
+    assert len(index.nearby(*CENTER, 1.0, None, k=10)) == 1
+
+    # Moving across cells must leave nothing behind in the old cell
+    index.upsert({**vendor, "location": {"lat": CENTER[0] + 0.5, "lng": CENTER[1]}})
+    assert index.nearby(*CENTER, 1.0, None, k=10) == []
+    assert len(index.nearby(CENTER[0] + 0.5, CENTER[1], 1.0, None, k=10)) == 1
+
+    index.remove("v1")
+    assert index.nearby(CENTER[0] + 0.5, CENTER[1], 1.0, None, k=10) == []
+    assert index.get("v1") is None
+
+
+def test_geo_index_grows_past_initial_capacity():
+    vendors = make_vendors(100)
+    index = VendorGeoIndex(cell_degrees=0.05)
+    for vendor in vendors:
+        index.upsert(vendor)
+    assert all(index.get(vendor["vendor_id"]) is not None for vendor in vendors)
+
+
+@pytest.fixture
+def geo_index(monkeypatch):
+    index = VendorGeoIndex(cell_degrees=0.05)
+    monkeypatch.setattr(server, "vendor_geo_index", index)
+    return index
+
+
+@pytest.mark.anyio
+async def test_endpoint_serves_from_loaded_index_and_follows_writes(db, geo_index):
+    vendors = make_vendors(200)
+    await db.hub_vendors.insert_many([dict(vendor) for vendor in vendors])
+    await geo_index.load()
+
+    lat, lng = CENTER
+    result = await server.get_hub_vendors(lat=lat, lng=lng, radius_km=5.0, limit=100)
+    expected = brute_force_nearby(vendors, lat, lng, 5.0, None)
+    assert [vendor["vendor_id"] for vendor in result] == [vendor_id for _, vendor_id in expected][:100]
+    assert all("_id" not in vendor for vendor in result)
+
+    # A vendor moving next to the caller shows up without reloading
+    server.on_vendor_changed({**vendors[0], "location": {"lat": lat, "lng": lng}})
+    result = await server.get_hub_vendors(lat=lat, lng=lng, radius_km=5.0, limit=1)
+    assert [(vendor["vendor_id"], vendor["distance_km"]) for vendor in result] == [("v0", 0.0)]
+
+
+@pytest.mark.anyio
+async def test_endpoint_paginates_index_results(db, geo_index):
+    vendors = make_vendors(300)
+    await db.hub_vendors.insert_many([dict(vendor) for vendor in vendors])
+    await geo_index.load()
+
+    lat, lng = CENTER
+    first = await server.get_hub_vendors(lat=lat, lng=lng, radius_km=10.0, skip=0, limit=20)
+    second = await server.get_hub_vendors(lat=lat, lng=lng, radius_km=10.0, skip=20, limit=20)
+    expected = [vendor_id for _, vendor_id in brute_force_nearby(vendors, lat, lng, 10.0, None)]
+    assert [vendor["vendor_id"] for vendor in first + second] == expected[:40]
+